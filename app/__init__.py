@@ -21,6 +21,10 @@ class AuthorizationSite(JSONRPCSite):
         if getattr(view_func, 'jsonrpc_options', {}).get('require_auth'):
             # 需要授权认证 token验证
             token = request.headers.get('X-Password')
+            from app import signed_token
+            if signed_token.is_signed(token):
+                # 签名 token 在内存中校验
+                return signed_token.verify(token)
             return mongo.db.token.find_one({
                 'token': token,
                 'expires_at': {'$gt': time.time()}
@@ -58,6 +62,10 @@ def create_app(config_obj):
     # MongoDB数据库初始化
     mongo.init_app(app)
 
+    # 创建缺失的索引
+    from app import indexes
+    indexes.init(mongo.db)
+
     jsonrpc.init_app(app)
 
     from app import onedrive, tmdb, apis
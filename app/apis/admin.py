@@ -1,11 +1,12 @@
 # -*- coding: utf-8 -*-
+import datetime
 import hashlib
 import time
 import uuid
 
 from flask_jsonrpc.exceptions import JSONRPCError
 
-from app import jsonrpc_bp
+from app import jsonrpc_bp, signed_token
 from app.app_config import g_app_config
 from . import mongodb
 
@@ -18,12 +19,21 @@ def gen_token():
 
 def insert_new_token():
     auth_token_max_age = g_app_config.get('admin', 'auth_token_max_age')
+    expires_at = time.time() + 3600 * 24 * auth_token_max_age
+    if g_app_config.get('admin', 'signed_token'):
+        # 签名 token 不保存到数据库
+        return {'token': signed_token.issue(expires_at),
+                'expires_at': int(expires_at)}
+
     res = {
         'token': gen_token(),
-        'expires_at': time.time() + 3600 * 24 * auth_token_max_age
+        'expires_at': expires_at
     }
-    mongodb.token.insert_one(res)
-    res.pop('_id', None)
+    mongodb.token.insert_one({
+        **res,
+        # 过期后由 TTL 索引自动删除
+        'expires_date': datetime.datetime.utcfromtimestamp(expires_at)
+    })
     return res
 
 
@@ -38,11 +48,19 @@ def auth(password: str) -> dict:
 
 @jsonrpc_bp.method('Admin.validateToken')
 def validate_token(token: str) -> dict:
-    # 删除过期token
-    mongodb.token.delete_many({'expires_at': {'$lt': time.time()}})
+    if signed_token.is_signed(token):
+        # 每验证一次token，让旧token失效
+        if not signed_token.revoke(token):
+            raise JSONRPCError(message='TokenError',
+                               data={'message': 'Token validation failed'})
+        return insert_new_token()
 
-    # 每验证一次token，让旧token失效
-    deleted_count = mongodb.token.delete_one({'token': token}).deleted_count
+    # 每验证一次token，让旧token失效。过期的 token 由 TTL 索引删除，
+    # 删除之前可能还在，需要检查过期时间
+    deleted_count = mongodb.token.delete_one({
+        'token': token,
+        'expires_at': {'$gt': time.time()}
+    }).deleted_count
     if deleted_count == 0:
         raise JSONRPCError(message='TokenError',
                            data={'message': 'Token validation failed'})
@@ -52,5 +70,8 @@ def validate_token(token: str) -> dict:
 
 @jsonrpc_bp.method('Admin.logout', require_auth=True)
 def logout(token: str) -> int:
+    if signed_token.is_signed(token):
+        signed_token.revoke(token)
+        return 0
     mongodb.token.delete_one({'token': token})
     return 0
@@ -29,7 +29,8 @@ class AppConfigItem:
         # "app_config" -> "App Config"
         self.name = detail.get('name') or ' '.join(
             s.capitalize() for s in key.split('_'))
-        self.value = detail.get('value') or ''
+        # false、0 等默认值保留原来的类型，否则会被当成字符串
+        self.value = detail['value'] if 'value' in detail.keys() else ''
         self.type = str(type(self.value))[8:-2]
         self.description = detail.get('description') or ''
         self.editable = detail.get('editable') is None or detail.get('editable')
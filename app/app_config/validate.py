@@ -66,11 +66,78 @@ def upload_threads_num(value: int) -> bool:
     return 0 < value <= 30
 
 
+@validator.register('onedrive.upload_drive_threads_num')
+def upload_drive_threads_num(value: int) -> bool:
+    return 0 < value <= 30
+
+
+@validator.register('onedrive.update_batch_size')
+def update_batch_size(value: int) -> bool:
+    return 0 < value <= 10000
+
+
+@validator.register('onedrive.delta_prefetch_pages')
+def delta_prefetch_pages(value: int) -> bool:
+    return 0 <= value <= 16
+
+
+@validator.register('onedrive.update_threads_num')
+def update_threads_num(value: int) -> bool:
+    return 0 < value <= 16
+
+
+@validator.register('onedrive.graph_pool_size')
+def graph_pool_size(value: int) -> bool:
+    return 0 < value <= 100
+
+
+@validator.register('onedrive.graph_rate_limit')
+def graph_rate_limit(value: int) -> bool:
+    return 0 < value <= 100
+
+
+@validator.register('onedrive.content_url_ttl')
+def content_url_ttl(value: int) -> bool:
+    return 0 < value <= 50
+
+
+@validator.register('onedrive.download_mode')
+def download_mode(value: str) -> bool:
+    return value in ('redirect', 'proxy')
+
+
+@validator.register('onedrive.disk_cache_size')
+def disk_cache_size(value: int) -> bool:
+    return 0 < value <= 102400
+
+
+@validator.register('onedrive.disk_cache_file_size')
+def disk_cache_file_size(value: int) -> bool:
+    return 0 < value <= 1024
+
+
+@validator.register('onedrive.item_fields')
+def item_fields(value: str) -> bool:
+    fields = set(field.strip() for field in value.split(','))
+    return fields.issuperset({'id', 'name', 'size', 'file', 'folder', 'root',
+                              'deleted', 'parentReference', 'cTag'})
+
+
+@validator.register('onedrive.tree_index')
+def tree_index(value: bool) -> bool:
+    return isinstance(value, bool)
+
+
 @validator.register('admin.auth_token_max_age')
 def auth_token_max_age(value: int) -> bool:
     return 0 < value <= 30
 
 
+@validator.register('admin.signed_token')
+def signed_token(value: bool) -> bool:
+    return isinstance(value, bool)
+
+
 @validator.register('others.default_local_path')
 def default_local_path(value: str) -> bool:
     path = value
@@ -1,5 +1,15 @@
 # -*- coding: utf-8 -*-
+import base64
+import binascii
 import datetime
+import functools
+import inspect
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Optional
 
 
 class CURDCounter:
@@ -81,3 +91,231 @@ class Utils:
             ) + Utils.path_with_slash(
                 path2, root=False
             ), root=root)
+
+    @staticmethod
+    def keyset_match(sort: list, last: dict) -> dict:
+        """
+        键集分页，返回排在 last 之后的文档的查询条件。
+        MongoDB 排序时 null（包括字段不存在）排在最小，这里按同样的顺序处理
+        :param sort: [(字段, 1 或 -1)]，与 $sort 的顺序相同，最后一个字段必须唯一
+        :param last: 上一页最后一个文档的排序字段的值
+        :return:
+        """
+        conditions = []
+        for i, (field, direction) in enumerate(sort):
+            condition = {f: last.get(f) for f, _ in sort[:i]}
+            value = last.get(field)
+            if value is None:
+                if direction == -1:
+                    # 降序时 null 排在最后，没有排在它后面的值
+                    continue
+                condition[field] = {'$ne': None}
+            elif direction == 1:
+                condition[field] = {'$gt': value}
+            else:
+                condition['$or'] = [{field: {'$lt': value}}, {field: None}]
+            conditions.append(condition)
+        if len(conditions) == 0:
+            # 不匹配任何文档
+            return {'_id': {'$in': []}}
+        return {'$or': conditions}
+
+    @staticmethod
+    def next_cursor(docs: list, sort: list, limit: int,
+                    tag: str) -> Optional[str]:
+        """
+        根据这一页最后一个文档生成下一页的 cursor，没有下一页返回 None
+        :param docs: 这一页的文档
+        :param sort: 与 keyset_match 相同
+        :param limit:
+        :param tag: 排序方式，排序方式不同的 cursor 不能通用
+        :return:
+        """
+        if len(docs) == 0 or len(docs) < limit:
+            return None
+        last = docs[-1]
+        data = {'tag': tag, 'last': {f: last.get(f) for f, _ in sort}}
+        return base64.urlsafe_b64encode(
+            json.dumps(data, separators=(',', ':')).encode('utf8')
+        ).decode('ascii')
+
+    @staticmethod
+    def parse_cursor(cursor: str, tag: str) -> Optional[dict]:
+        """
+        :param cursor: 空字符串表示第一页
+        :param tag:
+        :return: 上一页最后一个文档的排序字段的值，第一页返回 None。cursor 无效时抛出 ValueError
+        """
+        if cursor == '':
+            return None
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        except (binascii.Error, UnicodeError, ValueError):
+            raise ValueError('Invalid cursor')
+        if not isinstance(data, dict) or data.get('tag') != tag or \
+                not isinstance(data.get('last'), dict):
+            raise ValueError('Invalid cursor')
+        return data['last']
+
+
+class LRUCache:
+    """
+    线程安全的 LRU 缓存，可以为每个 key 设置过期时间（秒）。
+    get_or_load 在缓存未命中时调用 loader 加载，同一个 key 同时只会加载一次，
+    其他同时未命中的线程等待并共用加载结果。loader 返回 None 时不缓存。
+    加载期间 pop 或者 clear 了这个 key 时，加载结果也不缓存
+    """
+
+    def __init__(self, max_size=1024, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (过期时间, value)
+        self.data = OrderedDict()
+        # key -> 正在加载的 Future
+        self.loading = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _get(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            self.data.pop(key, None)
+            return None
+        self.data.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self._get(key)
+            if value is None:
+                return default
+            self.hits += 1
+            return value
+
+    def _set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        self.data[key] = (expires_at, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self._set(key, value, ttl)
+
+    def pop(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+            # 正在进行的加载可能读到了旧数据，之后的 get_or_load 重新加载
+            self.loading.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.loading.clear()
+
+    def get_or_load(self, key, loader, ttl=None):
+        with self.lock:
+            value = self._get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+
+            future = self.loading.get(key)
+            waiting = future is not None
+            if waiting:
+                self.coalesced += 1
+            else:
+                future = Future()
+                self.loading[key] = future
+                self.misses += 1
+        if waiting:
+            # 其他线程正在加载
+            return future.result()
+
+        try:
+            value = loader()
+        except BaseException as e:
+            with self.lock:
+                if self.loading.get(key) is future:
+                    self.loading.pop(key)
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            # 加载期间被 pop 的不缓存
+            if self.loading.get(key) is future:
+                self.loading.pop(key)
+                if value is not None:
+                    self._set(key, value, ttl)
+        future.set_result(value)
+        return value
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.data),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced
+            }
+
+
+class DataVersions:
+    """
+    每个数据范围（一个 drive 或者 TMDb 数据库）的版本号，数据改变后加一。
+    缓存的结果带有版本号，版本号改变后旧的结果不会再被命中，由 LRU 淘汰
+    """
+
+    def __init__(self):
+        # 数据范围 -> 版本号
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def get(self, scope: str) -> int:
+        with self.lock:
+            return self.versions.get(scope, 0)
+
+    def bump(self, scope: str):
+        with self.lock:
+            self.versions[scope] = self.versions.get(scope, 0) + 1
+
+
+data_versions = DataVersions()
+
+
+def versioned_cache(cache: LRUCache, scope: Callable[[dict], str]):
+    """
+    缓存 jsonrpc 方法的返回值，放在 jsonrpc_bp.method 下面。
+    key 由方法名、参数和数据范围的版本号组成，缓存的返回值不能修改
+    :param cache:
+    :param scope: 参数名 -> 参数值，返回数据范围
+    :return:
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            data_scope = scope(bound.arguments)
+            key = json.dumps([func.__name__, data_scope,
+                              data_versions.get(data_scope),
+                              bound.arguments],
+                             sort_keys=True, default=str)
+            return cache.get_or_load(key, lambda: func(*args, **kwargs))
+
+        # jsonrpc 根据函数签名校验参数
+        wrapper.__signature__ = signature
+        return wrapper
+
+    return decorator
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# 集合名 -> 需要的索引
+indexes = {
+    'drive': [
+        IndexModel([('id', ASCENDING)], name='id', unique=True),
+        IndexModel([('settings.public', ASCENDING)], name='settings_public'),
+    ],
+    'item': [
+        IndexModel([('id', ASCENDING)], name='id', unique=True),
+        IndexModel([('parentReference.driveId', ASCENDING),
+                    ('parentReference.path', ASCENDING),
+                    ('name', ASCENDING), ('id', ASCENDING)],
+                   name='drive_path_name_id'),
+        IndexModel([('parentReference.driveId', ASCENDING),
+                    ('parentReference.path', ASCENDING),
+                    ('lastModifiedDateTime', ASCENDING), ('id', ASCENDING)],
+                   name='drive_path_modified_id'),
+        IndexModel([('parentReference.id', ASCENDING)], name='parent_id'),
+        IndexModel([('parentReference.driveId', ASCENDING),
+                    ('sync_generation', ASCENDING)],
+                   name='drive_sync_generation'),
+        IndexModel([('movie_id', ASCENDING)], name='movie_id', sparse=True),
+    ],
+    'folder_listing': [
+        IndexModel([('drive_id', ASCENDING), ('path', ASCENDING)],
+                   name='drive_id_path', unique=True),
+    ],
+    'token': [
+        IndexModel([('token', ASCENDING)], name='token', unique=True),
+        IndexModel([('expires_date', ASCENDING)], name='expires_date_ttl',
+                   expireAfterSeconds=0),
+    ],
+    'token_revoked': [
+        IndexModel([('token_id', ASCENDING)], name='token_id', unique=True),
+        IndexModel([('revoked_at', ASCENDING)], name='revoked_at'),
+        IndexModel([('expires_at', ASCENDING)], name='expires_at_ttl',
+                   expireAfterSeconds=0),
+    ],
+    'app_secret': [
+        IndexModel([('name', ASCENDING)], name='name', unique=True),
+    ],
+    'auth_temp': [
+        IndexModel([('state', ASCENDING)], name='state'),
+        IndexModel([('expires_date', ASCENDING)], name='expires_date_ttl',
+                   expireAfterSeconds=0),
+    ],
+    'upload_info': [
+        IndexModel([('uid', ASCENDING)], name='uid', unique=True),
+        IndexModel([('status', ASCENDING)], name='status'),
+        IndexModel([('drive_id', ASCENDING), ('status', ASCENDING)],
+                   name='drive_id_status'),
+    ],
+    'tmdb_movie': [
+        IndexModel([('id', ASCENDING)], name='id', unique=True),
+        IndexModel([('release_date', ASCENDING), ('title', ASCENDING),
+                    ('id', ASCENDING)], name='release_date_title_id'),
+    ],
+    'tmdb_collection': [
+        IndexModel([('id', ASCENDING)], name='id', unique=True),
+    ],
+    'tmdb_person': [
+        IndexModel([('id', ASCENDING)], name='id', unique=True),
+    ],
+    'tmdb_genre': [
+        IndexModel([('id', ASCENDING)], name='id', unique=True),
+    ],
+}
+
+# 集合名 -> 已经被替换的索引，启动时删除
+obsolete_indexes = {
+    'item': ['drive_path_name'],
+    'tmdb_movie': ['release_date_title'],
+}
+
+# 集合名 -> 主要的查询条件，启动时检查是否使用了索引
+query_shapes = {
+    'drive': [{'id': ''}],
+    'item': [
+        {'id': ''},
+        {'parentReference.driveId': '', 'parentReference.path': ''},
+        {'parentReference.driveId': '', 'parentReference.path': '',
+         'name': ''},
+        {'parentReference.id': ''},
+        {'movie_id': 0},
+    ],
+    'folder_listing': [{'drive_id': '', 'path': ''}],
+    'token': [{'token': '', 'expires_at': {'$gt': 0}}],
+    'upload_info': [{'uid': ''}, {'status': ''}],
+    'tmdb_movie': [{'id': 0}],
+}
+
+
+def ensure_indexes(db):
+    """
+    删除已经被替换的索引，创建缺失的索引，已存在的索引不会重复创建
+    :param db:
+    :return:
+    """
+    for collection_name, names in obsolete_indexes.items():
+        existing = db[collection_name].index_information().keys()
+        for name in names:
+            if name in existing:
+                db[collection_name].drop_index(name)
+                logger.info('index {}.{} dropped'.format(collection_name,
+                                                         name))
+
+    for collection_name, models in indexes.items():
+        collection = db[collection_name]
+        existing = collection.index_information().keys()
+        for model in models:
+            name = model.document['name']
+            if name in existing:
+                continue
+            try:
+                collection.create_indexes([model])
+                logger.info('index {}.{} created'.format(collection_name,
+                                                         name))
+            except OperationFailure as e:
+                # 例如已有重复数据，无法创建唯一索引
+                logger.error('index {}.{} creation failed: {}'.format(
+                    collection_name, name, e))
+
+
+def has_collscan(plan) -> bool:
+    if isinstance(plan, dict):
+        if plan.get('stage') == 'COLLSCAN':
+            return True
+        return any(has_collscan(v) for v in plan.values())
+    if isinstance(plan, list):
+        return any(has_collscan(v) for v in plan)
+    return False
+
+
+def check_query_plans(db):
+    """
+    对主要的查询执行 explain，使用了全表扫描（COLLSCAN）时发出警告
+    :param db:
+    :return:
+    """
+    for collection_name, filters in query_shapes.items():
+        for query in filters:
+            plan = db[collection_name].find(query).explain()
+            winning_plan = (plan.get('queryPlanner') or {}).get('winningPlan')
+            if has_collscan(winning_plan):
+                logger.warning('query on {} uses COLLSCAN: {}'.format(
+                    collection_name, list(query.keys())))
+
+
+def backfill_ttl_fields(db):
+    """
+    旧版本写入的文档没有 TTL 索引使用的 expires_date 字段，不会被自动删除
+    :param db:
+    :return:
+    """
+    db.token.update_many({'expires_date': {'$exists': False}}, [
+        {'$set': {'expires_date': {
+            '$toDate': {'$multiply': ['$expires_at', 1000]}
+        }}}
+    ])
+    # 旧版本的登录状态最多保留10分钟，重启后已经没有用了
+    db.auth_temp.delete_many({'expires_date': {'$exists': False}})
+
+
+def init(db):
+    ensure_indexes(db)
+    backfill_ttl_fields(db)
+    check_query_plans(db)
@@ -2,18 +2,159 @@
 import datetime
 import logging
 import threading
+import uuid
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from pymongo import UpdateOne, UpdateMany, DeleteMany
 
 from app import mongo
+from app.app_config import g_app_config
+from . import listing
 from .graph import auth, drive_api
-from ..common import CURDCounter
+from .tree import tree_index
+from ..common import CURDCounter, LRUCache, data_versions
 
 logger = logging.getLogger(__name__)
 mongodb = mongo.db
+# 本项目在 item 中添加的字段，不是来自 Graph
+app_item_fields = ['content', 'create_link', 'movie_id', 'tv_series_id',
+                   'sync_generation']
+# 同步时下载 HEAD.md 和 README.md 的线程池
+md_executor = ThreadPoolExecutor(max_workers=4,
+                                 thread_name_prefix='md-fetcher')
+# item_id -> {'name', 'size', 'mime_type', 'tag', 'url': 下载地址}
+# 同步时删除重命名、移动、删除或者内容改变了的 item
+content_url_cache = LRUCache(max_size=4096)
+# 每次同步后最多预先生成的文件夹列表文档数量
+listing_warm_size = 500
+
+
+def data_scope(drive_id: str) -> str:
+    """
+    drive 的数据范围，数据改变后 data_versions 中的版本号加一
+    """
+    return 'drive:' + drive_id
+
+
+class TokenManager:
+    """
+    在内存中缓存每个 drive 的 token，MongoDB 只用于持久化，不会每次都读取。
+    每个 drive 一把锁，token 快过期时只有一个线程去刷新，同时到达的其他线程等待并共用刷新结果
+    """
+
+    def __init__(self):
+        # drive id -> token
+        self.tokens = {}
+        # drive id -> 该 drive 的刷新锁
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def drive_lock(self, drive_id: str) -> threading.Lock:
+        with self.lock:
+            lock = self.locks.get(drive_id)
+            if lock is None:
+                lock = threading.Lock()
+                self.locks[drive_id] = lock
+            return lock
+
+    def get(self, drive_id: str, ahead=300):
+        """
+        :param drive_id:
+        :param ahead: token 在 ahead 秒内过期就刷新
+        :return:
+        """
+        token = self.tokens.get(drive_id)
+        if token is not None and not auth.expires_soon(token, ahead):
+            return token
+
+        with self.drive_lock(drive_id):
+            # 等待锁的过程中，其他线程可能已经刷新过了
+            token = self.tokens.get(drive_id)
+            if token is not None and not auth.expires_soon(token, ahead):
+                return token
+
+            # 其他进程可能已经刷新并保存过了
+            doc = mongodb.drive.find_one({'id': drive_id}, {'token': 1})
+            token = (doc or {}).get('token')
+            if token is None or not auth.expires_soon(token, ahead):
+                self.set(drive_id, token)
+                return token
+
+            new_token = auth.refresh_token(token, ahead)
+            if new_token is not None:
+                mongodb.drive.update_one({'id': drive_id},
+                                         {'$set': {'token': new_token}})
+                logger.info('drive({}) token updated'.format(drive_id))
+            self.set(drive_id, new_token)
+            return new_token
+
+    def set(self, drive_id: str, token):
+        with self.lock:
+            if token is None:
+                self.tokens.pop(drive_id, None)
+            else:
+                self.tokens[drive_id] = token
+
+    def renew_all(self, ahead: int):
+        """
+        提前刷新所有 ahead 秒内过期的 token
+        :param ahead:
+        :return:
+        """
+        for drive_id in Drive.all_drive_ids():
+            try:
+                self.get(drive_id, ahead)
+            except Exception as e:
+                logger.error('drive({}) token renew failed: {}'.format(
+                    drive_id, e))
+
+
+token_manager = TokenManager()
+
+
+class DriveRegistry:
+    """
+    在内存中缓存 drive 文档（owner、settings、base_down_url、quota 等），
+    不包括 token 和同步进度。修改 drive 文档后需要调用 invalidate。
+    返回的文档是共享的，调用方不能修改
+    """
+    projection = {'_id': 0, 'token': 0, 'delta_link': 0,
+                  'delta_checkpoint': 0}
+
+    def __init__(self):
+        # drive id -> drive 文档
+        self.drives = {}
+        # drive id -> invalidate 的次数。读取期间被 invalidate 的文档不缓存
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def get(self, drive_id: str) -> Optional[dict]:
+        doc = self.drives.get(drive_id)
+        if doc is None:
+            with self.lock:
+                version = self.versions.get(drive_id, 0)
+            doc = mongodb.drive.find_one({'id': drive_id}, self.projection)
+            if doc is not None:
+                with self.lock:
+                    if self.versions.get(drive_id, 0) == version:
+                        self.drives[drive_id] = doc
+        return doc
+
+    def invalidate(self, drive_id: str):
+        with self.lock:
+            self.drives.pop(drive_id, None)
+            self.versions[drive_id] = self.versions.get(drive_id, 0) + 1
+
+
+drive_registry = DriveRegistry()
 
 
 class Drive:
-    token_lock = threading.Lock()
-    update_lock = threading.Lock()
+    # drive id -> 该 drive 的更新锁，不同 drive 之间可以同时更新
+    update_locks = {}
+    update_locks_lock = threading.Lock()
 
     @staticmethod
     def create_from_id(drive_id):
@@ -51,32 +192,34 @@ class Drive:
 
     @property
     def token(self):
-        with self.token_lock:
-            if self._token:
-                token = self._token
-            else:
-                doc = mongodb.drive.find_one({'id': self.id}, {'token': 1})
-                token = (doc or {}).get('token')
-
-            # TODO new_token 为 None 时怎么处理
-            new_token = auth.refresh_token(token)
+        if self._id is None:
+            # 使用 token 初始化，还没有 store_drive
+            self._token = auth.refresh_token(self._token)
+            return self._token
+
+        # TODO token 为 None 时怎么处理
+        token = token_manager.get(self._id)
+        if token is not None:
+            # drive_api 根据 drive_id 对每个 drive 分别限流
+            return {**token, 'drive_id': self._id}
+        return token
 
-            if new_token != token:
-                # updated
-                self._token = new_token
-                mongodb.drive.update_one({'id': self.id},
-                                         {'$set': {'token': new_token}})
-                logger.info(
-                    'drive({}) token updated'.format(self.user['email']))
-            return new_token
+    @property
+    def update_lock(self):
+        drive_id = self.id
+        with self.update_locks_lock:
+            lock = self.update_locks.get(drive_id)
+            if lock is None:
+                lock = threading.Lock()
+                self.update_locks[drive_id] = lock
+            return lock
 
     @property
     def user(self):
         if self._user:
             return self._user
         if self._id:
-            drive_json = mongodb.drive.find_one({'id': self.id}, {'owner': 1})
-            self._user = drive_json['owner']['user']
+            self._user = drive_registry.get(self.id)['owner']['user']
         else:
             self.store_drive()
         return self._user
@@ -92,9 +235,11 @@ class Drive:
 
         res = mongodb.drive.update_one(
             {'id': self.id},
-            {'$set': {**drive_json, 'token': self.token}},
+            {'$set': {**drive_json, 'token': self._token}},
             upsert=True
         )
+        token_manager.set(self.id, self._token)
+        drive_registry.invalidate(self.id)
         logger.info('drive({}) stored'.format(self.user['email']))
 
         return res
@@ -109,111 +254,421 @@ class Drive:
                 drive_json = drive_api.drive(self.token)
                 mongodb.drive.update_one({'id': drive_json['id']},
                                          {'$set': drive_json})
+                drive_registry.invalidate(drive_json['id'])
                 logger.info('drive({}) updated'.format(self.user['email']))
 
             # update items
             delta_link = None
-            if full_update:
-                # 先将原有id全部保存，然后每更新一个item，就删除item_temp里对应的id，
-                # 最后剩余的id就是已经无效的了
-                mongodb.item_temp.delete_many({})
-                for item in mongodb.item.find(
-                        {'parentReference.driveId': self.id},
-                        {'id': 1}
-                ):
-                    mongodb.item_temp.insert_one({'id': item['id']})
+            # 全量更新时，每个 item 写入后标记本次同步的 generation，
+            # 最后 generation 不是本次的 item 就是已经无效的了
+            generation = None
+            drive_doc = mongodb.drive.find_one(
+                {'id': self.id}, {'delta_link': 1, 'delta_checkpoint': 1})
+            # 上次更新中断时保存的进度，从中断的那一页继续
+            checkpoint = drive_doc.get('delta_checkpoint') or {}
+            resuming = False
+            if checkpoint.get('next_link') and (
+                    not full_update or checkpoint.get('generation')):
+                delta_link = checkpoint['next_link']
+                generation = checkpoint.get('generation')
+                resuming = True
+                logger.info('drive({}) resumes items update from checkpoint'
+                            .format(self.user['email']))
+            elif full_update:
+                generation = uuid.uuid4().hex
             else:
-                drive_doc = mongodb.drive.find_one({'id': self.id},
-                                                   {'delta_link': 1})
                 delta_link = drive_doc.get('delta_link')
 
-            for resp_json in drive_api.delta(self.token, delta_link):
-                if '@odata.deltaLink' in resp_json.keys():
-                    delta_link = resp_json['@odata.deltaLink']
-
-                items = resp_json['value']
-                for item in items:
-                    if item['@odata.type'] != '#microsoft.graph.driveItem':
-                        continue
-
-                    if 'deleted' in item.keys() and item['deleted'].get(
-                            'state') == 'deleted':
-                        # 删
-                        counter.deleted += mongodb.item.delete_many({
-                            'id': item['id']
-                        }).deleted_count
-                    else:
-                        # 下载HEAD.md或者README.md
-                        if (item['name'] == 'README.md' or item[
-                            'name'] == 'HEAD.md') and \
-                                item['size'] <= 1024 * 1024:
-                            from app.onedrive.graph.drive_api import content
-                            resp = content(self.token, item['id'])
-                            item['content'] = resp.text
-
-                        # 增、改
-                        res = mongodb.item.update_one({'id': item['id']},
-                                                      {'$set': item},
-                                                      upsert=True)
-                        if res.matched_count > 0:
-                            if res.modified_count > 0:
-                                counter.updated += 1
-                        else:
-                            counter.added += 1
-
-                        if full_update:
-                            # 每更新一个item，就删除item_temp里对应的id
-                            mongodb.item_temp.delete_many({'id': item['id']})
+            batch_size = g_app_config.get('onedrive', 'update_batch_size')
+            # item id -> item。同一批次内同一个 item 只保留最后一次出现的数据，
+            # 无序 bulk_write 不保证执行顺序
+            batch = {}
+            # 本次更新受影响的文件夹，更新结束后重新生成它们的列表文档
+            affected = set()
+            fields = item_fields()
+            prefetch = g_app_config.get('onedrive', 'delta_prefetch_pages')
+            if prefetch > 0:
+                # 写入当前页的同时在后台获取后面的页
+                pages = drive_api.delta_prefetch(self.token, delta_link,
+                                                 fields, prefetch)
+            else:
+                pages = drive_api.delta(self.token, delta_link, fields)
+            try:
+                for resp_json in pages:
+                    if 'value' not in resp_json.keys():
+                        if resuming:
+                            # 保存的进度已失效，下次重新开始
+                            mongodb.drive.update_one(
+                                {'id': self.id},
+                                {'$unset': {'delta_checkpoint': ''}})
+                        raise Exception(str(resp_json.get('error')))
+                    resuming = False
+
+                    if '@odata.deltaLink' in resp_json.keys():
+                        delta_link = resp_json['@odata.deltaLink']
+
+                    items = resp_json['value']
+                    for item in items:
+                        if item.get('@odata.type',
+                                    '#microsoft.graph.driveItem') \
+                                != '#microsoft.graph.driveItem':
+                            continue
+
+                        # 只保存需要的字段
+                        item = {k: v for k, v in item.items() if k in fields}
+
+                        batch[item['id']] = item
+                        if len(batch) >= batch_size:
+                            counter.merge(self.commit_batch(batch, affected,
+                                                            generation))
+
+                    # 每一页结束后提交剩余的 item，并保存进度
+                    counter.merge(self.commit_batch(batch, affected,
+                                                    generation))
+                    if '@odata.nextLink' in resp_json.keys():
+                        mongodb.drive.update_one({'id': self.id}, {'$set': {
+                            'delta_checkpoint': {
+                                'next_link': resp_json['@odata.nextLink'],
+                                'generation': generation
+                            }
+                        }})
+            finally:
+                # 出错退出时也要结束预取线程
+                pages.close()
+
+            if generation:
+                # 删除本次全量更新没有出现过的 item
+                deleted = mongodb.item.delete_many({
+                    'parentReference.driveId': self.id,
+                    'sync_generation': {'$ne': generation}
+                }).deleted_count
+                counter.deleted += deleted
+                if deleted > 0:
+                    # 不知道删除的 item 在哪些文件夹，全部重新生成
+                    listing.invalidate_tree(self.id)
+                    tree_index.drop(self.id)
+                    data_versions.bump(data_scope(self.id))
 
             mongodb.drive.update_one({'id': self.id},
-                                     {'$set': {'delta_link': delta_link}})
-
-            if full_update:
-                # 剩余的id就是已经无效的了，删除它
-                for item in mongodb.item_temp.find():
-                    mongodb.item.delete_many({'id': item['id']})
-                    counter.deleted += 1
+                                     {'$set': {'delta_link': delta_link},
+                                      '$unset': {'delta_checkpoint': ''}})
+
+            # 预先生成受影响的文件夹的列表文档，浅的目录访问得多，先生成。
+            # 超过 listing_warm_size 的在第一次访问时生成
+            for drive_id, path in sorted(
+                    affected, key=lambda x: (x[1].count('/'), x[1])
+            )[:listing_warm_size]:
+                listing.build(drive_id, path)
+            if tree_index.enabled() and self.id not in tree_index.trees:
+                tree_index.build(self.id)
 
             logger.info(
                 'drive({}) items updated: {}'.format(self.user['email'],
                                                      counter.detail()))
             return counter
 
+    def commit_batch(self, batch: dict, affected: Optional[set] = None,
+                     generation: Optional[str] = None) -> CURDCounter:
+        self.fetch_md_contents(batch)
+        return bulk_write_items(batch, affected, generation)
+
+    def fetch_md_contents(self, batch: dict):
+        """
+        下载 batch 中的 HEAD.md 和 README.md，内容保存在 item['content']。
+        cTag 没有变化并且已经保存过内容的文件不再下载，需要下载的文件在线程池中并行下载
+        :param batch: item id -> item
+        :return:
+        """
+        md_items = {item_id: item for item_id, item in batch.items()
+                    if not is_deleted(item) and is_md_file(item)}
+        if len(md_items) == 0:
+            return
+
+        for doc in mongodb.item.find(
+                {'id': {'$in': list(md_items.keys())},
+                 'content': {'$type': 'string'}},
+                {'id': 1, 'cTag': 1, 'eTag': 1}
+        ):
+            item = md_items[doc['id']]
+            tag = item.get('cTag') or item.get('eTag')
+            if tag and tag == (doc.get('cTag') or doc.get('eTag')):
+                # 内容没有变化
+                md_items.pop(doc['id'])
+
+        if len(md_items) == 0:
+            return
+
+        # 通过 $batch 获取下载地址，再并行下载
+        urls = drive_api.batch_content_url(self.token, list(md_items.keys()))
+        futures = {item_id: md_executor.submit(drive_api.download, url)
+                   for item_id, url in urls.items() if url}
+        for item_id, item in md_items.items():
+            resp = None
+            try:
+                if item_id in futures.keys():
+                    resp = futures[item_id].result()
+            except requests.RequestException as e:
+                logger.error('download {} failed: {}'.format(item['name'], e))
+            # 下载失败时置空，下次同步重新下载
+            item['content'] = resp.text if resp is not None and resp.ok \
+                else None
+
     def remove(self):
         email = self.user['email']
         mongodb.drive.delete_many({'id': self.id})
         mongodb.item.delete_many({'parentReference.driveId': self.id})
+        listing.invalidate_tree(self.id)
+        tree_index.drop(self.id)
+        data_versions.bump(data_scope(self.id))
+        token_manager.set(self.id, None)
+        drive_registry.invalidate(self.id)
         logger.info('drive({}) removed'.format(email))
 
 
-def auto_update():
+def item_fields() -> list:
     """
-    每天24点自动更新
+    同步时需要从 Graph 获取并保存的 item 字段
+    """
+    return [field.strip() for field in
+            g_app_config.get('onedrive', 'item_fields').split(',')
+            if field.strip()]
+
+
+def slim_item_docs() -> int:
+    """
+    删除已保存的 item 中不需要的字段，本项目自己添加的字段会保留
+    :return: 修改的 item 数量
+    """
+    keep = item_fields() + app_item_fields
+    return mongodb.item.update_many(
+        {}, [{'$project': {field: 1 for field in keep}}]
+    ).modified_count
+
+
+def is_md_file(item: dict) -> bool:
+    return item.get('name') in ('README.md', 'HEAD.md') and \
+           item.get('size', 0) <= 1024 * 1024
+
+
+def is_deleted(item: dict) -> bool:
+    return 'deleted' in item.keys() and item['deleted'].get(
+        'state') == 'deleted'
+
+
+def folder_path(item: dict):
+    """
+    文件夹自身的路径，即其子项的 parentReference.path。根目录返回 None
+    """
+    parent_path = (item.get('parentReference') or {}).get('path')
+    if parent_path is None:
+        return None
+    return parent_path + '/' + item['name']
+
+
+def bulk_write_items(batch: dict, affected: Optional[set] = None,
+                     generation: Optional[str] = None) -> CURDCounter:
+    """
+    以无序 bulk_write 批量写入 delta 返回的 item，提交后清空 batch。
+    文件夹重命名或者移动后，delta 不会返回其子项，这里同时修改所有子项的路径。
+    写入后删除受影响的文件夹的列表文档
+    :param batch: item id -> item
+    :param affected: 不为 None 时，受影响的 (drive id, 文件夹路径) 添加到这里
+    :param generation: 全量更新时本次同步的 generation，写入后标记到 item
+    :return: 根据 bulk_write 结果统计的增删改数量
+    """
+    if len(batch) == 0:
+        return CURDCounter()
+
+    # 写入前读取已保存的位置，item 移动后原来的文件夹也受影响
+    stored = {doc['id']: doc for doc in mongodb.item.find(
+        {'id': {'$in': list(batch.keys())}},
+        {'id': 1, 'name': 1, 'cTag': 1, 'parentReference.driveId': 1,
+         'parentReference.path': 1}
+    )}
+    paths = set()
+    for item_id, item in batch.items():
+        for doc in (item, stored.get(item_id)):
+            parent = (doc or {}).get('parentReference') or {}
+            if parent.get('driveId') and parent.get('path'):
+                paths.add((parent['driveId'], parent['path']))
+
+    # 找出路径改变了的文件夹
+    moved_folders = {}
+    moved_trees = set()
+    for item_id, item in batch.items():
+        if 'folder' not in item.keys() or is_deleted(item) \
+                or item_id not in stored.keys():
+            continue
+        old_path = folder_path(stored[item_id])
+        new_path = folder_path(item)
+        if new_path is not None and old_path != new_path:
+            moved_folders[item_id] = new_path
+            drive_id = item['parentReference'].get('driveId')
+            moved_trees.update({(drive_id, old_path), (drive_id, new_path)})
+
+    operations = []
+    for item_id, item in batch.items():
+        if is_deleted(item):
+            # 删
+            operations.append(DeleteMany({'id': item_id}))
+        else:
+            # 增、改
+            operations.append(UpdateOne({'id': item_id},
+                                        {'$set': item},
+                                        upsert=True))
+
+    res = mongodb.item.bulk_write(operations, ordered=False)
+    if generation:
+        # 单独标记 generation，不计入修改数量，内容没变的 item 不算更新
+        mongodb.item.update_many(
+            {'id': {'$in': [item_id for item_id, item in batch.items()
+                            if not is_deleted(item)]}},
+            {'$set': {'sync_generation': generation}})
+    for item_id, item in batch.items():
+        doc = stored.get(item_id)
+        if doc is None:
+            continue
+        if is_deleted(item) or item.get('name') != doc.get('name') or \
+                item.get('cTag') != doc.get('cTag') or \
+                (item.get('parentReference') or {}).get('path') != \
+                (doc.get('parentReference') or {}).get('path'):
+            # 缓存的下载地址、文件名、大小已经失效
+            content_url_cache.pop(item_id)
+    tree_index.apply(batch.values())
+    batch.clear()
+    counter = CURDCounter(added=res.upserted_count,
+                          updated=res.modified_count,
+                          deleted=res.deleted_count)
+    if len(moved_folders) > 0:
+        counter.updated += rewrite_sub_paths(moved_folders)
+
+    for drive_id in {drive_id for drive_id, _ in paths}:
+        listing.invalidate(drive_id, [path for d, path in paths
+                                      if d == drive_id])
+        data_versions.bump(data_scope(drive_id))
+    for drive_id, path in moved_trees:
+        listing.invalidate_tree(drive_id, path)
+    if affected is not None:
+        affected.update(paths)
+    return counter
+
+
+def rewrite_sub_paths(folder_paths: dict) -> int:
+    """
+    根据 parentReference.id 逐层修改子项的 parentReference.path，
+    每一层只需要一次 bulk_write 和一次查询
+    :param folder_paths: 文件夹 id -> 文件夹的新路径
+    :return: 修改的 item 数量
+    """
+    modified = 0
+    parents = folder_paths
+    while len(parents) > 0:
+        res = mongodb.item.bulk_write([
+            UpdateMany({'parentReference.id': parent_id,
+                        'parentReference.path': {'$ne': path}},
+                       {'$set': {'parentReference.path': path}})
+            for parent_id, path in parents.items()
+        ], ordered=False)
+        modified += res.modified_count
+
+        # 下一层的文件夹
+        children = {}
+        for doc in mongodb.item.find(
+                {'parentReference.id': {'$in': list(parents.keys())},
+                 'folder': {'$exists': True}},
+                {'id': 1, 'name': 1, 'parentReference.id': 1}
+        ):
+            children[doc['id']] = '{}/{}'.format(
+                parents[doc['parentReference']['id']], doc['name'])
+        parents = children
+    return modified
+
+
+def update_drives(drive_ids: list, full_update=False) -> CURDCounter:
+    """
+    使用线程池同时更新多个 drive，合并各个 drive 的增删改数量。
+    所有 drive 更新结束后，如果有 drive 更新失败，抛出第一个异常
+    :param drive_ids:
+    :param full_update:
     :return:
     """
-    drive_ids = []
-    for drive_id in Drive.all_drive_ids():
-        Drive.create_from_id(drive_id).update()
-        drive_ids.append(drive_id)
+    counter = CURDCounter()
+    error = None
+    max_workers = g_app_config.get('onedrive', 'update_threads_num')
+    with ThreadPoolExecutor(max_workers=max_workers,
+                            thread_name_prefix='drive-updater') as executor:
+        futures = {
+            executor.submit(Drive.create_from_id(drive_id).update,
+                            full_update=full_update): drive_id
+            for drive_id in drive_ids
+        }
+        for future in as_completed(futures):
+            try:
+                counter.merge(future.result())
+            except Exception as e:
+                logger.error('drive({}) update failed: {}'.format(
+                    futures[future], e))
+                error = error or e
+
+    if error is not None:
+        raise error
+    return counter
 
-    from app.tmdb.api.updater import update_movie_data
-    update_movie_data(drive_ids)
 
-    now = datetime.datetime.now()
-    mid_night = datetime.datetime(now.year, now.month, now.day, 23, 59, 59)
-    timedelta = mid_night - now
+def auto_update():
+    """
+    每天24点自动更新
+    :return:
+    """
+    try:
+        drive_ids = list(Drive.all_drive_ids())
+        try:
+            update_drives(drive_ids)
+        except Exception as e:
+            # 有 drive 更新失败也继续更新电影数据
+            logger.error(e)
+
+        from app.tmdb.api.updater import update_movie_data
+        update_movie_data(drive_ids)
+    except Exception as e:
+        logger.error(e)
+    finally:
+        # 不管更新是否成功都要安排下一次更新
+        now = datetime.datetime.now()
+        mid_night = datetime.datetime(now.year, now.month, now.day,
+                                      23, 59, 59)
+        timedelta = mid_night - now
+
+        # 加10s防抖
+        timer = threading.Timer(timedelta.seconds + 10, auto_update)
+        timer.name = 'onedrive-auto-updater'
+        timer.daemon = True
+        timer.start()
+
+
+def auto_renew_tokens():
+    """
+    每5分钟刷新20分钟内过期的 token，请求时就不需要等待刷新了
+    :return:
+    """
+    token_manager.renew_all(ahead=20 * 60)
 
-    # 加10s防抖
-    timer = threading.Timer(timedelta.seconds + 10, auto_update)
-    timer.name = 'onedrive-auto-updater'
+    timer = threading.Timer(5 * 60, auto_renew_tokens)
+    timer.name = 'onedrive-token-renewer'
     timer.daemon = True
     timer.start()
 
 
 def init():
     from . import api
-    # 清空 auth_temp
-    mongodb.auth_temp.delete_many({})
+    # 全量更新已改用 sync_generation，删除旧版本遗留的 item_temp 集合
+    mongodb.item_temp.drop()
+
+    # 在自动更新之前建立目录树，之后由 Drive.update 增量修改
+    tree_index.build_all(Drive.all_drive_ids())
+
+    # 自动刷新token
+    auto_renew_tokens()
 
     # 自动更新items
     auto_update()
@@ -1,115 +1,180 @@
 # -*- coding: utf-8 -*-
 import datetime
+import json
+import logging
 import os
-from typing import Union, Literal
+from typing import Union, Literal, Optional
 
-from flask import redirect, abort
+from flask import redirect, abort, request, send_file, Response, \
+    stream_with_context
 from flask_jsonrpc.exceptions import InvalidRequestError
+from pymongo import UpdateOne
+import requests
 
 from app import jsonrpc_bp
+from app.app_config import g_app_config
 from . import onedrive_route_bp, onedrive_root_path
 from .manage import get_settings
-from .. import mongodb, Drive
+from .. import mongodb, Drive, drive_registry, listing, data_scope, \
+    content_url_cache
+from ..disk_cache import disk_cache
 from ..graph import drive_api
-from ...common import Utils
+from ..listing import get_items_projection, add_ftype
+from ..tree import tree_index
+from ...common import Utils, LRUCache, versioned_cache, data_versions
 
-get_items_projection = {
-    '_id': 0, 'id': 1, 'name': 1, 'file': 1, 'folder': 1,
-    'lastModifiedDateTime': 1, 'size': 1, 'movie_id': 1, 'tv_series_id': 1,
-}
+logger = logging.getLogger(__name__)
+
+
+# 统计某个目录下 item 数量的缓存，键集分页时不需要每一页都重新统计。
+# key 带有 drive 的版本号，数据改变后不再命中
+count_cache = LRUCache(max_size=1024, ttl=60)
+# 公开的查询方法的返回值，drive 的数据改变后不再命中
+response_cache = LRUCache(max_size=4096)
+
+
+def drive_scope(params: dict) -> str:
+    return data_scope(params['drive_id'])
 
 
 @jsonrpc_bp.method('Onedrive.getItemsByPath')
+@versioned_cache(response_cache, drive_scope)
 def get_items_by_path(
         drive_id: str, path: str, skip: int = 0, limit: int = 20,
         query: dict = None, order: Literal['asc', 'desc'] = 'asc',
         order_by: Literal['name', 'lastModifiedDateTime'] = 'name',
-        append_md_files=False
+        append_md_files=False, cursor: str = None
 ) -> dict:
     """
-    文件夹移动或者重命名后，使用 deltaLink 更新，不会更新文件夹的子项的数据。
-    也就是说使用本方查找重命名过的文件夹的子项的结果是空的，全量更新后没有问题。
+    cursor 为 None 时使用 skip 分页；否则使用键集分页并忽略 skip，
+    第一页传空字符串，之后传上一页结果中的 cursor。
+    结果中的 cursor 用于获取下一页，为 None 表示没有下一页
     """
     query = query or {}
 
     settings = get_settings(drive_id)
     path = Utils.path_join(settings['root_path'], path, root=False)
 
-    for result in mongodb.item.aggregate([
-        {'$match': {
-            **query,
-            'parentReference.driveId': drive_id,
-            'parentReference.path': onedrive_root_path + path,
-        }},
-        {'$project': get_items_projection},
-        {'$facet': {
-            'count': [{'$count': 'count'}],
-            'list': [
-                {'$addFields': {'ftype': {'$cond': [
-                    {'$ifNull': ['$folder', False]}, 0, 1
-                ]}}},
-                {'$sort': {
-                    'ftype': 1 if order == 'asc' else -1,
-                    order_by: 1 if order == 'asc' else -1
-                }},
-                {'$skip': skip},
-                {'$limit': limit}
-            ]
-        }},
-        {'$set': {'count': {'$let': {
-            'vars': {'firstElem': {'$arrayElemAt': ['$count', 0]}},
-            'in': '$$firstElem.count'
-        }}}},
-        {'$set': {'count': {'$ifNull': ['$count', {'$toInt': 0}]}}}
-    ]):
+    match = {
+        **query,
+        'parentReference.driveId': drive_id,
+        'parentReference.path': onedrive_root_path + path,
+    }
+    direction = 1 if order == 'asc' else -1
+    # 文件夹在前，最后按 id 排序保证顺序稳定。id 与 order_by 方向相同，
+    # 降序时可以反向使用同一个索引
+    sort = [('ftype', direction), (order_by, direction), ('id', direction)]
+    tag = '{}:{}'.format(order_by, order)
+
+    results = []
+    doc = None
+    # 键集分页忽略 skip，第一页从头开始
+    start = skip if cursor is None else 0
+    if len(query) == 0 and sort == listing.default_sort and not cursor:
+        # 默认排序的第一页直接使用文件夹的列表文档
+        doc = listing.get(drive_id, onedrive_root_path + path)
+        if start + limit > len(doc['children']) and \
+                not listing.complete(doc):
+            doc = None
+    if doc is not None:
+        results.append({
+            'count': doc['count'],
+            'list': doc['children'][start:start + limit]
+        })
+    elif cursor is not None:
+        try:
+            last = Utils.parse_cursor(cursor, tag)
+        except ValueError as e:
+            raise InvalidRequestError(message=str(e))
+        if last is not None and last.get('ftype') not in (0, 1):
+            raise InvalidRequestError(message='Invalid cursor')
+
+        scope = data_scope(drive_id)
+        count_key = json.dumps([scope, data_versions.get(scope), match],
+                               sort_keys=True)
+        results.append({
+            'count': count_cache.get_or_load(
+                count_key, lambda: mongodb.item.count_documents(match)),
+            'list': keyset_page(match, sort, last, limit)
+        })
+    else:
+        results = mongodb.item.aggregate([
+            {'$match': match},
+            {'$project': get_items_projection},
+            {'$facet': {
+                'count': [{'$count': 'count'}],
+                'list': [
+                    add_ftype,
+                    {'$sort': dict(sort)},
+                    {'$skip': skip},
+                    {'$limit': limit}
+                ]
+            }},
+            {'$set': {'count': {'$let': {
+                'vars': {'firstElem': {'$arrayElemAt': ['$count', 0]}},
+                'in': '$$firstElem.count'
+            }}}},
+            {'$set': {'count': {'$ifNull': ['$count', {'$toInt': 0}]}}}
+        ])
+
+    for result in results:
+        result['cursor'] = Utils.next_cursor(result['list'], sort, limit, tag)
+
         if append_md_files:
-            md_files = {'head': None, 'readme': None}
-            for item in mongodb.item.aggregate([
-                {'$match': {
-                    'name': {'$in': ['README.md', 'HEAD.md']},
-                    'parentReference.driveId': drive_id,
-                    'parentReference.path': onedrive_root_path + path,
-                }},
-                {'$project': {'_id': 0, 'name': 1, 'content': 1}},
-            ]):
-                if item['name'] == 'README.md':
-                    md_files['readme'] = item.get('content')
-                if item['name'] == 'HEAD.md':
-                    md_files['head'] = item.get('content')
+            if doc is None:
+                doc = listing.get(drive_id, onedrive_root_path + path)
+            md_files = {'head': doc['head'], 'readme': doc['readme']}
 
             result = {**result, **md_files}
 
         return result
 
-    return {'count': 0, 'list': []}
+    return {'count': 0, 'list': [], 'cursor': None}
+
+
+def keyset_page(match: dict, sort: list, last: Optional[dict],
+                limit: int) -> list:
+    """
+    ftype 是计算出来的字段，不能使用索引。这里把文件夹和文件分开查询，
+    每次查询都在索引字段上 $match、$sort、$limit，翻页的开销与第一页相同
+    :param match:
+    :param sort: [('ftype', d), (order_by, d), ('id', d)]
+    :param last: 上一页最后一个文档的排序字段的值，第一页为 None
+    :param limit:
+    :return:
+    """
+    ftypes = [0, 1] if sort[0][1] == 1 else [1, 0]
+    res = []
+    for ftype in ftypes:
+        if last is not None and ftypes.index(ftype) < \
+                ftypes.index(last.get('ftype')):
+            # 上一页已经翻过了这一类
+            continue
+        conditions = [match, {'folder': {'$exists': ftype == 0}}]
+        if last is not None and last.get('ftype') == ftype:
+            conditions.append(Utils.keyset_match(sort[1:], last))
+        for doc in mongodb.item.find({'$and': conditions},
+                                     get_items_projection)\
+                .sort(sort[1:]).limit(limit - len(res)):
+            doc['ftype'] = ftype
+            res.append(doc)
+        if len(res) >= limit:
+            break
+    return res
 
 
 @jsonrpc_bp.method('Onedrive.getMdByPath')
+@versioned_cache(response_cache, drive_scope)
 def get_md_by_path(drive_id: str, path: str) -> dict:
     settings = get_settings(drive_id)
     path = Utils.path_join(settings['root_path'], path, root=False)
 
-    res = {
-        'head': '',
-        'readme': ''
+    doc = listing.get(drive_id, onedrive_root_path + path)
+    return {
+        'head': doc['head'] or '',
+        'readme': doc['readme'] or ''
     }
 
-    for item in mongodb.item.aggregate([
-        {'$match': {
-            'parentReference.driveId': drive_id,
-            'parentReference.path': onedrive_root_path + path,
-            'name': {'$in': ['README.md', 'HEAD.md']}
-        }},
-        {'$project': {'_id': 0, 'name': 1, 'content': 1}},
-    ]):
-        if item['name'] == 'README.md':
-            res['readme'] = item.get('content') or ''
-
-        if item['name'] == 'HEAD.md':
-            res['head'] = item.get('content') or ''
-
-    return res
-
 
 @jsonrpc_bp.method('Onedrive.listDrivePath', require_auth=True)
 def list_drive_path(drive_id: str, path: str) -> Union[list, int]:
@@ -122,6 +187,23 @@ def list_drive_path(drive_id: str, path: str) -> Union[list, int]:
     # 根目录为空字符串，其他目录以 '/' 开头
     path = Utils.path_with_slash(path, root=False)
 
+    tree = tree_index.get(drive_id)
+    if tree is not None:
+        with tree.lock:
+            node = tree.find(path)
+            if node is not None and not node.is_folder:
+                return 0
+            res = []
+            for child in tree.list_children(path) or []:
+                d = {'value': child.name or 'null',
+                     'type': 'folder' if child.is_folder else 'file'}
+                if child.is_folder:
+                    d['childCount'] = len(child.children)
+                else:
+                    d['size'] = child.size
+                res.append(d)
+        return sorted(res, key=lambda x: x['value'].upper())
+
     query = {
         'parentReference.driveId': drive_id,
         'parentReference.path': onedrive_root_path + path
@@ -162,30 +244,209 @@ def get_item(item_id: str) -> dict:
     return doc
 
 
-@jsonrpc_bp.method('Onedrive.getItemContentUrl')
-def get_item_content_url(item_id: str, item: dict = None) -> str:
-    item_doc = item or get_item(item_id)
+# 代理模式下每次转发的数据块大小
+proxy_chunk_size = 256 * 1024
+# 代理模式下转发给客户端的上游响应头
+proxy_headers = ['Content-Type', 'Content-Length', 'Content-Range',
+                 'Accept-Ranges', 'ETag', 'Last-Modified']
+
+
+def load_content_url(item_id: str) -> Optional[dict]:
+    # 缓存是所有请求共用的，只能使用数据库中的 item
+    item_doc = mongodb.item.find_one({'id': item_id}, {'_id': 0})
+    if item_doc is None:
+        return None
 
     if 'folder' in item_doc.keys():
         raise InvalidRequestError(message='You cannot get content for a folder')
 
-    if item_doc['size'] > 50 * 1024 * 1024:
+    drive = Drive.create_from_id(item_doc['parentReference']['driveId'])
+    url = drive_api.content_url(drive.token, item_id)
+    if url is None:
+        return None
+    return {
+        'name': item_doc['name'],
+        'size': item_doc['size'],
+        'mime_type': (item_doc.get('file') or {}).get('mimeType'),
+        'tag': item_doc.get('cTag') or item_doc.get('eTag'),
+        'url': url
+    }
+
+
+def cached_content_url(item_id: str) -> Optional[dict]:
+    """
+    下载地址有效期约1小时，缓存时间需要比它短。
+    同一个 item 同时未命中时只请求一次 Graph
+    """
+    ttl = g_app_config.get('onedrive', 'content_url_ttl') * 60
+    return content_url_cache.get_or_load(
+        item_id, lambda: load_content_url(item_id), ttl)
+
+
+@jsonrpc_bp.method('Onedrive.getItemContentUrl')
+def get_item_content_url(item_id: str, item: dict = None) -> str:
+    """
+    :param item_id:
+    :param item: 已弃用，保留参数只是为了兼容旧的客户端，不会被使用
+    :return:
+    """
+    content_url = cached_content_url(item_id)
+    if content_url is None:
+        raise InvalidRequestError(message='Cannot find item')
+
+    if content_url['size'] > 50 * 1024 * 1024:
         raise InvalidRequestError(message='Large file uses shared link')
+    return content_url['url']
 
-    drive = Drive.create_from_id(item_doc['parentReference']['driveId'])
-    return drive_api.content_url(drive.token, item_id)
+
+@jsonrpc_bp.method('Onedrive.contentUrlCacheStats', require_auth=True)
+def content_url_cache_stats() -> dict:
+    return {**content_url_cache.stats(), 'disk_cache': disk_cache.stats(),
+            'response_cache': response_cache.stats()}
 
 
 @onedrive_route_bp.route('/<item_id>/<name>', methods=['GET'])
 def item_content(item_id, name):
-    item = mongodb.item.find_one({'id': item_id, 'name': name})
-    if item is None:
+    try:
+        content_url = cached_content_url(item_id)
+    except InvalidRequestError:
         abort(404)
+    if content_url is None or content_url['name'] != name:
+        abort(404)
+    return send_content(item_id, content_url)
+
+
+@onedrive_route_bp.route('/path/<drive_id>/<path:path>', methods=['GET'])
+def item_content_by_path(drive_id, path):
+    """
+    按路径下载文件，path 相对于 drive 设置的 root_path
+    """
     try:
-        content_url = get_item_content_url(item_id, item)
-        return redirect(content_url)
+        settings = get_settings(drive_id)
     except InvalidRequestError:
         abort(404)
+    path = Utils.path_join(settings['root_path'], path, root=False)
+
+    item_id = find_file_id(drive_id, path)
+    if item_id is None:
+        abort(404)
+    content_url = cached_content_url(item_id)
+    if content_url is None:
+        abort(404)
+    return send_content(item_id, content_url)
+
+
+def find_file_id(drive_id: str, path: str) -> Optional[str]:
+    """
+    开启了内存目录树时从目录树查找，否则使用 item 集合的
+    (parentReference.driveId, parentReference.path, name) 索引查找
+    :param drive_id:
+    :param path: 相对于 drive 根目录的路径
+    :return: 文件的 id，不存在或者是文件夹时为 None
+    """
+    tree = tree_index.get(drive_id)
+    if tree is not None:
+        node = tree.find(path)
+        if node is None or node.is_folder:
+            return None
+        return node.id
+
+    d, f = os.path.split(path)
+    if f == '':
+        return None
+    item_doc = mongodb.item.find_one({
+        'parentReference.driveId': drive_id,
+        'parentReference.path': Utils.path_join(onedrive_root_path, d),
+        'name': f
+    }, {'id': 1, 'file': 1}) or {}
+    if item_doc.get('file') is None:
+        return None
+    return item_doc['id']
+
+
+def send_content(item_id: str, content_url: dict):
+    if g_app_config.get('onedrive', 'download_mode') == 'proxy':
+        return proxy_content(item_id, content_url)
+
+    if content_url['size'] > 50 * 1024 * 1024:
+        abort(404)
+    return redirect(content_url['url'])
+
+
+class ExpiredContentUrl(Exception):
+    pass
+
+
+def send_cached_file(f, content_url: dict):
+    """
+    发送已经打开的缓存文件。send_file 不知道文件对象的大小，
+    这里设置 Content-Length 后再处理 Range 请求
+    """
+    size = os.fstat(f.fileno()).st_size
+    # 文件对象没有文件名，send_file 无法推断 mimetype，必须传入
+    mimetype = content_url['mime_type'] or 'application/octet-stream'
+    rv = send_file(f, mimetype=mimetype, add_etags=False, conditional=False)
+    rv.content_length = size
+    rv.set_etag(content_url['tag'])
+    return rv.make_conditional(request, accept_ranges=True,
+                               complete_length=size)
+
+
+def proxy_content(item_id: str, content_url: dict):
+    """
+    代理模式，由服务器转发文件内容。小文件缓存到本地磁盘，由 send_file 发送；
+    其他文件按固定大小分块转发，不会整个读入内存，并且支持 Range 请求
+    """
+    max_file_size = g_app_config.get('onedrive', 'disk_cache_file_size')
+    if content_url['tag'] and \
+            content_url['size'] <= max_file_size * 1024 * 1024:
+        key = '{}:{}'.format(item_id, content_url['tag'])
+        f = disk_cache.open(key)
+        if f is None:
+            def write(file):
+                resp = drive_api.download(content_url['url'], stream=True)
+                with resp:
+                    if resp.status_code in (401, 403, 404):
+                        raise ExpiredContentUrl()
+                    resp.raise_for_status()
+                    for chunk in resp.iter_content(proxy_chunk_size):
+                        file.write(chunk)
+
+            try:
+                disk_cache.load(key, write)
+            except ExpiredContentUrl:
+                # 下载地址已失效
+                content_url_cache.pop(item_id)
+                abort(404)
+            except requests.RequestException as e:
+                logger.error(e)
+                abort(502)
+            f = disk_cache.open(key)
+        if f is not None:
+            return send_cached_file(f, content_url)
+
+    headers = {}
+    if request.headers.get('Range'):
+        headers['Range'] = request.headers['Range']
+    resp = drive_api.download(content_url['url'], stream=True,
+                              headers=headers)
+    if resp.status_code in (401, 403, 404):
+        # 下载地址已失效
+        resp.close()
+        content_url_cache.pop(item_id)
+        abort(404)
+
+    def generate():
+        try:
+            for chunk in resp.iter_content(proxy_chunk_size):
+                yield chunk
+        finally:
+            resp.close()
+
+    return Response(stream_with_context(generate()),
+                    status=resp.status_code,
+                    headers={k: resp.headers[k] for k in proxy_headers
+                             if k in resp.headers})
 
 
 @jsonrpc_bp.method('Onedrive.getItemSharedLink')
@@ -207,13 +468,8 @@ def get_item_shared_link(item_id: str, item: dict = None) -> Union[str, None]:
 
     drive_id = item_doc['parentReference']['driveId']
     base_down_url = get_base_down_url(drive_id, item_id)
-    web_url = create_link['link']['webUrl']
-    share = web_url[web_url.rfind('/') + 1:]
-    # download.aspx 加上 '/' 再在后面加任意字符串都行，这里加个文件名方便识别
-    direct_link = base_down_url.replace(
-        '?share=', '/' + item_doc['name'] + '?share=') + share
-
-    return direct_link
+    return direct_link(base_down_url, item_doc['name'],
+                       create_link['link']['webUrl'])
 
 
 @jsonrpc_bp.method('Onedrive.createItemSharedLink')
@@ -224,9 +480,9 @@ def create_item_shared_link(item_id: str) -> str:
     :return:
     """
     item_doc = get_item(item_id)
-    direct_link = get_item_shared_link(item_id, item_doc)
-    if direct_link:
-        return direct_link
+    shared_link = get_item_shared_link(item_id, item_doc)
+    if shared_link:
+        return shared_link
 
     drive_id = item_doc['parentReference']['driveId']
     drive = Drive.create_from_id(drive_id)
@@ -237,13 +493,51 @@ def create_item_shared_link(item_id: str) -> str:
                             {'$set': {'create_link': resp_json}})
 
     base_down_url = get_base_down_url(drive_id, item_id)
-    web_url = resp_json['link']['webUrl']
-    share = web_url[web_url.rfind('/') + 1:]
-    # download.aspx 加上 '/' 再在后面加任意字符串都行，这里加个文件名方便识别
-    direct_link = base_down_url.replace(
-        '?share=', '/' + item_doc['name'] + '?share=') + share
+    return direct_link(base_down_url, item_doc['name'],
+                       resp_json['link']['webUrl'])
+
+
+@jsonrpc_bp.method('Onedrive.createItemSharedLinks')
+def create_item_shared_links(item_ids: list) -> dict:
+    """
+    批量创建资源链接，同一个 drive 的链接通过 $batch 一起创建
+    :param item_ids:
+    :return: item_id -> 资源链接，文件夹或者创建失败时为 None
+    """
+    res = {}
+    # drive_id -> 需要创建链接的 item
+    to_be_created = {}
+    for item_doc in mongodb.item.find({'id': {'$in': item_ids}}, {'_id': 0}):
+        if 'folder' in item_doc.keys():
+            continue
+        link = get_item_shared_link(item_doc['id'], item_doc)
+        if link:
+            res[item_doc['id']] = link
+            continue
+        drive_id = item_doc['parentReference']['driveId']
+        to_be_created.setdefault(drive_id, []).append(item_doc)
 
-    return direct_link
+    next_4_days = Utils.utc_datetime(timedelta=datetime.timedelta(days=4))
+    for drive_id, item_docs in to_be_created.items():
+        drive = Drive.create_from_id(drive_id)
+        links = drive_api.batch_create_link(
+            drive.token, [item_doc['id'] for item_doc in item_docs],
+            next_4_days)
+
+        operations = []
+        for item_doc in item_docs:
+            resp_json = links[item_doc['id']]
+            if 'link' not in resp_json.keys():
+                continue
+            operations.append(UpdateOne({'id': item_doc['id']},
+                                        {'$set': {'create_link': resp_json}}))
+            base_down_url = get_base_down_url(drive_id, item_doc['id'])
+            res[item_doc['id']] = direct_link(base_down_url, item_doc['name'],
+                                              resp_json['link']['webUrl'])
+        if len(operations) > 0:
+            mongodb.item.bulk_write(operations, ordered=False)
+
+    return {item_id: res.get(item_id) for item_id in item_ids}
 
 
 @jsonrpc_bp.method('Onedrive.deleteItemSharedLink', require_auth=True)
@@ -262,13 +556,19 @@ def delete_item_shared_link(item_id: str) -> int:
     return 0
 
 
+def direct_link(base_down_url, name, web_url):
+    share = web_url[web_url.rfind('/') + 1:]
+    # download.aspx 加上 '/' 再在后面加任意字符串都行，这里加个文件名方便识别
+    return base_down_url.replace('?share=', '/' + name + '?share=') + share
+
+
 def get_base_down_url(drive_id, item_id):
     """
     :param drive_id: drive_id 必须存在
     :param item_id: 任意一个有效的 item_id
     :return:
     """
-    drive_doc = mongodb.drive.find_one({'id': drive_id}, {'base_down_url': 1})
+    drive_doc = drive_registry.get(drive_id)
     base_down_url = drive_doc.get('base_down_url')
 
     if base_down_url:
@@ -280,4 +580,5 @@ def get_base_down_url(drive_id, item_id):
     base_down_url = tmp_url[:tmp_url.find(symbol) + len(symbol)] + 'share='
     mongodb.drive.update_one({'id': drive.id},
                              {'$set': {'base_down_url': base_down_url}})
+    drive_registry.invalidate(drive.id)
     return base_down_url
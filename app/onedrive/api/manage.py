@@ -7,9 +7,11 @@ from typing import Union
 from flask_jsonrpc.exceptions import InvalidRequestError
 
 from app import jsonrpc_bp
-from app.common import CURDCounter, Utils
-from .. import Drive, mongodb
+from app.common import Utils, data_versions
+from .. import Drive, mongodb, drive_registry, update_drives, \
+    slim_item_docs, data_scope
 from ..graph import drive_api
+from ..tree import tree_index
 
 logger = logging.getLogger(__name__)
 
@@ -23,15 +25,16 @@ def update(drive_ids: Union[str, list], entire=False) -> dict:
     elif isinstance(drive_ids, list):
         ids.extend(drive_ids)
 
-    counter = CURDCounter()
-    for drive_id in ids:
-        if entire:
-            ct = Drive.create_from_id(drive_id).update(full_update=True)
-        else:
-            ct = Drive.create_from_id(drive_id).update()
-        counter.merge(ct)
+    return update_drives(ids, full_update=entire).json()
 
-    return counter.json()
+
+@jsonrpc_bp.method('Onedrive.slimItems', require_auth=True)
+def slim_items() -> int:
+    """
+    只需执行一次，删除旧版本保存的 item 中不需要的字段
+    :return:
+    """
+    return slim_item_docs()
 
 
 @jsonrpc_bp.method('Onedrive.getDrives', require_auth=True)
@@ -58,6 +61,25 @@ def show_threads() -> list:
     return res
 
 
+@jsonrpc_bp.method('Onedrive.graphStats', require_auth=True)
+def graph_stats() -> dict:
+    """
+    每个 drive 请求 Graph 的次数、被限流次数、重试次数和等待时长（秒）
+    :return:
+    """
+    with drive_api.stats_lock:
+        return {k: v.copy() for k, v in drive_api.stats.items()}
+
+
+@jsonrpc_bp.method('Onedrive.treeIndexStats', require_auth=True)
+def tree_index_stats() -> dict:
+    """
+    每个 drive 的内存目录树的节点数量和估算的内存占用（字节）
+    :return:
+    """
+    return tree_index.stats()
+
+
 # @jsonrpc_bp.method('Onedrive.apiTest', require_auth=True)
 def api_test(drive_id: str, method: str, url: str, **kwargs) -> dict:
     drive = Drive.create_from_id(drive_id)
@@ -114,11 +136,12 @@ default_settings = {
 
 @jsonrpc_bp.method('Onedrive.getSettings', require_auth=True)
 def get_settings(drive_id: str) -> dict:
-    doc = mongodb.drive.find_one({'id': drive_id}, {'_id': 0, 'settings': 1})
+    doc = drive_registry.get(drive_id)
     if doc is None:
         raise InvalidRequestError(message='Cannot find drive')
 
-    settings = doc.get('settings') or {}
+    # 缓存的文档不能修改
+    settings = dict(doc.get('settings') or {})
     for k, v in default_settings.items():
         settings[k] = settings.get(k) or v
 
@@ -139,4 +162,7 @@ def modify_settings(drive_id: str, name: str,
                                  {'$set': {'settings.' + name: new_value}})
     if r.matched_count == 0:
         return -1
+    drive_registry.invalidate(drive_id)
+    # root_path 等设置会影响查询结果
+    data_versions.bump(data_scope(drive_id))
     return 0
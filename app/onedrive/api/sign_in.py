@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import datetime
 import logging
 import threading
 from typing import Union
@@ -15,14 +16,12 @@ logger = logging.getLogger(__name__)
 @jsonrpc_bp.method('Onedrive.getSignInUrl', require_auth=True)
 def get_sign_in_url() -> str:
     sign_in_url, state = auth.get_sign_in_url()
-    mongodb.auth_temp.insert_one({'state': state})
-    # 10分钟后自动清除
-    timer = threading.Timer(10 * 60,
-                            lambda st: mongodb.auth_temp.delete_one(
-                                {'state': st}),
-                            (state,))
-    timer.name = 'temp-auth-cleaner'
-    timer.start()
+    # 10分钟后由 TTL 索引自动清除
+    mongodb.auth_temp.insert_one({
+        'state': state,
+        'expires_date': datetime.datetime.utcnow() + datetime.timedelta(
+            minutes=10)
+    })
 
     return sign_in_url
 
@@ -37,7 +36,11 @@ def put_callback_url(url: str) -> int:
         raise JSONRPCError(message='URL错误')
     state = states[0]
 
-    doc = mongodb.auth_temp.find_one({'state': state})
+    # TTL 索引每分钟清理一次，过期但还没删除的也算超时
+    doc = mongodb.auth_temp.find_one({
+        'state': state,
+        'expires_date': {'$gt': datetime.datetime.utcnow()}
+    })
     if doc is None:
         # 登录超时
         raise JSONRPCError(message='登录超时')
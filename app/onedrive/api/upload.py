@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
+import heapq
+import itertools
 import logging
 import math
 import os
 import threading
 import time
 import uuid
-from typing import Dict, List, Literal, Callable, Any, Tuple
+from typing import Dict, List, Literal, Callable, Any, Tuple, Optional
 
 import requests
 from flask_jsonrpc.exceptions import InvalidRequestError
@@ -48,6 +50,8 @@ class UploadInfo:
         self.finished_date_time: str = kwargs.get('finished_date_time') or '---'
         self.status: str = kwargs.get('status') or 'pending'
         self.error = kwargs.get('error')
+        # 越大越先上传
+        self.priority: int = kwargs.get('priority') or 0
         # self._commit必须放到最后赋值，而且赋值只能有一次。字典对象是可更改的
         self._commit = {}
 
@@ -78,6 +82,49 @@ class UploadInfo:
         return res
 
 
+class ChunkBuffers:
+    """
+    上传分片的缓冲区，上传线程结束后放回，下一个上传线程继续使用。
+    最多保留 upload_threads_num 个，内存占用不超过线程数乘以分片大小
+    """
+
+    def __init__(self):
+        self.free: List[bytearray] = []
+        self.lock = threading.Lock()
+
+    def acquire(self, size: int) -> bytearray:
+        with self.lock:
+            while len(self.free) > 0:
+                buffer = self.free.pop()
+                if len(buffer) >= size:
+                    return buffer
+                # 分片大小改大了，丢弃旧的缓冲区
+        return bytearray(size)
+
+    def release(self, buffer: bytearray):
+        size = 1024 * 1024 * g_app_config.get('onedrive', 'upload_chunk_size')
+        with self.lock:
+            if len(buffer) == size and len(self.free) < \
+                    g_app_config.get('onedrive', 'upload_threads_num'):
+                self.free.append(buffer)
+
+
+chunk_buffers = ChunkBuffers()
+
+
+def read_chunk(f, view: memoryview) -> memoryview:
+    """
+    把文件内容读入 view，返回实际读到的部分
+    """
+    n = 0
+    while n < len(view):
+        read = f.readinto(view[n:])
+        if not read:
+            break
+        n += read
+    return view[:n]
+
+
 class UploadThread(threading.Thread):
     def __init__(self, uid: str):
         super().__init__(name=uid, daemon=True)
@@ -102,6 +149,7 @@ class UploadThread(threading.Thread):
         chunk_size = 1024 * 1024 * size_mb
 
         info = UploadInfo.create_from_mongo(self.uid)
+        buffer = None
         try:
             # 直接上传，最大为4MB
             if info.size <= 4 * 1024 * 1024:
@@ -161,10 +209,12 @@ class UploadThread(threading.Thread):
             if info.size < chunk_size:
                 chunk_size = math.floor(info.size / (1024 * 10)) * 1024 * 10
 
-            with open(info.file_path, 'rb') as f:
+            buffer = chunk_buffers.acquire(chunk_size)
+            with open(info.file_path, 'rb') as f, memoryview(buffer) as view:
                 f.seek(info.finished, 0)
 
                 upload_session = requests.Session()
+                limiter = drive_api.rate_limiter(info.drive_id)
 
                 while True:
                     start_time = time.time()
@@ -188,18 +238,25 @@ class UploadThread(threading.Thread):
                                                                  info.size)
                     }
 
-                    data = f.read(chunk_size)
+                    # 读入复用的缓冲区，以 memoryview 发送，不会复制
+                    data = read_chunk(f, view[:chunk_size])
                     res = None
                     while res is None:
                         try:
+                            limiter.acquire()
                             res = upload_session.put(info.upload_url,
                                                      headers=headers,
                                                      data=data)
-                            if res.status_code >= 500:
-                                # OneDrive服务器错误，稍后继续尝试
+                            if res.status_code == 429 or \
+                                    res.status_code >= 500:
+                                # 被限流或者OneDrive服务器错误，稍后继续尝试
                                 logger.warning(res.text)
+                                delay = drive_api.retry_after(res.headers) or 5
+                                if res.status_code in (429, 503):
+                                    drive_api.count(info.drive_id, 'throttled')
+                                    limiter.pause(delay)
                                 res = None
-                                time.sleep(5)
+                                time.sleep(delay)
                             elif res.status_code >= 400:
                                 # 文件未找到，因为其他原因被删除
                                 raise Exception(str(res.json()['error']))
@@ -235,6 +292,9 @@ class UploadThread(threading.Thread):
             info.error = str(e)
             info.commit()
         finally:
+            if buffer is not None:
+                chunk_buffers.release(buffer)
+
             if info.status == 'finished':
                 Drive.create_from_id(info.drive_id).update()
 
@@ -251,25 +311,47 @@ class UploadThread(threading.Thread):
 
 
 class UploadThreadPool(threading.Thread):
+    """
+    上传任务调度。等待中的任务按 drive 分组，每组是一个按优先级排序的堆；
+    有新任务或者有任务结束时唤醒调度线程，在总线程数 upload_threads_num
+    和每个 drive 的线程数 upload_drive_threads_num 限制内启动任务
+    """
+
     def __init__(self):
         super().__init__(name='upload-thread-pool', daemon=True)
         self.pool: Dict[str, UploadThread] = {}
-        self.pending: List[str] = []
+        # uid -> (drive_id, 序号)，序号用于识别堆中已经删除的任务
+        self.pending: Dict[str, Tuple[str, int]] = {}
+        # drive_id -> [(-priority, 序号, uid)]
+        self.queues: Dict[str, List[Tuple[int, int, str]]] = {}
+        # drive_id -> 运行中的任务数量
+        self.running: Dict[str, int] = {}
+        self.seq = itertools.count()
         self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
 
-    def add_task(self, uid: str):
-        with self.lock:
-            if uid in self.pending or uid in self.pool.keys():
+    def add_task(self, uid: str, drive_id: str, priority: int = 0):
+        """
+        :param uid:
+        :param drive_id:
+        :param priority: 越大越先上传，相同优先级按添加顺序上传
+        :return:
+        """
+        with self.cond:
+            if uid in self.pending.keys() or uid in self.pool.keys():
                 return -1
-            self.pending.append(uid)
+            seq = next(self.seq)
+            self.pending[uid] = (drive_id, seq)
+            heapq.heappush(self.queues.setdefault(drive_id, []),
+                           (-priority, seq, uid))
+            self.cond.notify()
             return 0
 
     def stop_task(self, uid: str):
         with self.lock:
             flag = -1
-            if uid in self.pending:
-                # 停止等待中的任务
-                self.pending.remove(uid)
+            if self.pending.pop(uid, None) is not None:
+                # 停止等待中的任务，堆中的记录在调度时跳过
                 flag = 0
             elif uid in self.pool.keys():
                 # 停止运行中的任务
@@ -280,9 +362,8 @@ class UploadThreadPool(threading.Thread):
     def delete_task(self, uid: str):
         with self.lock:
             flag = -1
-            if uid in self.pending:
+            if self.pending.pop(uid, None) is not None:
                 # 删除等待中的任务
-                self.pending.remove(uid)
                 flag = 0
             elif uid in self.pool.keys():
                 # 删除运行中的任务
@@ -290,26 +371,58 @@ class UploadThreadPool(threading.Thread):
                 flag = 0
             return flag
 
-    def pop(self, uid):
-        with self.lock:
-            self.pool.pop(uid, None)
+    def pop(self, uid, drive_id):
+        with self.cond:
+            if self.pool.pop(uid, None) is not None:
+                self.running[drive_id] -= 1
+            self.cond.notify()
+
+    def next_task(self) -> Optional[Tuple[str, str]]:
+        """
+        从没有达到线程数限制的 drive 中选出优先级最高的任务
+        :return: (uid, drive_id)，没有可以启动的任务时为 None
+        """
+        drive_limit = g_app_config.get('onedrive', 'upload_drive_threads_num')
+        best = None
+        for drive_id in list(self.queues.keys()):
+            queue = self.queues[drive_id]
+            # 跳过已经停止或删除的任务
+            while len(queue) > 0 and \
+                    self.pending.get(queue[0][2]) != (drive_id, queue[0][1]):
+                heapq.heappop(queue)
+            if len(queue) == 0:
+                del self.queues[drive_id]
+                continue
+            if self.running.get(drive_id, 0) >= drive_limit:
+                continue
+            if best is None or queue[0] < self.queues[best][0]:
+                best = drive_id
+        if best is None:
+            return None
+        _, _, uid = heapq.heappop(self.queues[best])
+        del self.pending[uid]
+        return uid, best
 
     def run(self):
-        while True:
-            with self.lock:
-                while len(self.pending) > 0 and len(self.pool) < \
+        with self.cond:
+            while True:
+                while len(self.pool) < \
                         g_app_config.get('onedrive', 'upload_threads_num'):
-                    # 有等待任务并且线程池没有满
-                    uid = self.pending.pop(0)
+                    # 线程池没有满
+                    task = self.next_task()
+                    if task is None:
+                        break
+                    uid, drive_id = task
                     thread = UploadThread(uid)
-                    thread.on_finished(self.pop, (uid,))
+                    thread.on_finished(self.pop, (uid, drive_id))
                     # 在这里添加入线程池，而不是在UploadThread start后
                     # 是为了保持pool同步
                     self.pool[uid] = thread
+                    self.running[drive_id] = self.running.get(drive_id, 0) + 1
                     thread.start()
 
-            # 充分释放锁给其他线程
-            time.sleep(1)
+                # 等待新任务或者任务结束，等待时释放锁
+                self.cond.wait()
 
 
 for init_doc in mongodb.upload_info.find({'$or': [
@@ -325,12 +438,14 @@ upload_pool.start()
 
 
 @jsonrpc_bp.method('Onedrive.uploadFile', require_auth=True)
-def upload_file(drive_id: str, upload_path: str, file_path: str) -> int:
+def upload_file(drive_id: str, upload_path: str, file_path: str,
+                priority: int = 0) -> int:
     """
 
     :param drive_id:
     :param upload_path: 上传至此目录下，结尾带‘/’
     :param file_path: 本地文件路径
+    :param priority: 越大越先上传
     :return:
     """
     upload_path = upload_path.strip().replace('\\', '/')
@@ -354,21 +469,24 @@ def upload_file(drive_id: str, upload_path: str, file_path: str) -> int:
                              file_path=file_path,
                              upload_path=upload_path,
                              size=file_size,
-                             created_date_time=Utils.str_datetime())
+                             created_date_time=Utils.str_datetime(),
+                             priority=priority)
     mongodb.upload_info.insert_one(upload_info.json())
 
-    upload_pool.add_task(uid)
+    upload_pool.add_task(uid, drive_id, priority)
 
     return 0
 
 
 @jsonrpc_bp.method('Onedrive.uploadFolder', require_auth=True)
-def upload_folder(drive_id: str, upload_path: str, folder_path: str) -> int:
+def upload_folder(drive_id: str, upload_path: str, folder_path: str,
+                  priority: int = 0) -> int:
     """
     上传文件夹下的所有文件，不包括子文件夹
     :param drive_id:
     :param upload_path: 上传至此目录下，结尾带‘/’
     :param folder_path: 上传此目录下的文件，结尾带'/'
+    :param priority: 越大越先上传
     :return:
     """
     upload_path = upload_path.strip().replace('\\', '/')
@@ -399,19 +517,20 @@ def upload_folder(drive_id: str, upload_path: str, folder_path: str) -> int:
                                  file_path=file_path,
                                  upload_path=upload_path + folder_name + '/',
                                  size=file_size,
-                                 created_date_time=Utils.str_datetime())
+                                 created_date_time=Utils.str_datetime(),
+                                 priority=priority)
         mongodb.upload_info.insert_one(upload_info.json())
 
-        upload_pool.add_task(uid)
+        upload_pool.add_task(uid, drive_id, priority)
     return 0
 
 
 @jsonrpc_bp.method('Onedrive.upload', require_auth=True)
 def upload(drive_id: str, upload_path: str, local_path: str,
-           type: Literal['file', 'folder']) -> int:
+           type: Literal['file', 'folder'], priority: int = 0) -> int:
     if type == 'file':
-        return upload_file(drive_id, upload_path, local_path)
-    return upload_folder(drive_id, upload_path, local_path)
+        return upload_file(drive_id, upload_path, local_path, priority)
+    return upload_folder(drive_id, upload_path, local_path, priority)
 
 
 @jsonrpc_bp.method('Onedrive.uploadStatus', require_auth=True)
@@ -480,7 +599,14 @@ def upload_status(drive_id: str = None, status: str = None, page: int = 0,
 
 
 @jsonrpc_bp.method('Onedrive.startUpload', require_auth=True)
-def start_upload(uid: str = None, uids: list = None) -> int:
+def start_upload(uid: str = None, uids: list = None,
+                 priority: int = None) -> int:
+    """
+    :param uid:
+    :param uids:
+    :param priority: 为 None 时使用添加任务时的优先级
+    :return:
+    """
     uids = uids or []
     if uid:
         uids.append(uid)
@@ -489,9 +615,12 @@ def start_upload(uid: str = None, uids: list = None) -> int:
         doc = mongodb.upload_info.find_one({'uid': uid}) or {}
         status = doc.get('status')
         if status == 'stopped' or status == 'error':
-            mongodb.upload_info.update_one({'uid': uid},
-                                           {'$set': {'status': 'pending'}})
-            upload_pool.add_task(uid)
+            task_priority = (doc.get('priority') or 0) \
+                if priority is None else priority
+            mongodb.upload_info.update_one(
+                {'uid': uid},
+                {'$set': {'status': 'pending', 'priority': task_priority}})
+            upload_pool.add_task(uid, doc['drive_id'], task_priority)
 
     return 0
 
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Optional, BinaryIO
+
+from app.app_config import g_app_config
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class DiskCache:
+    """
+    本地文件缓存，总大小超过 onedrive.disk_cache_size 时按 LRU 删除文件。
+    key 由 item id 和 cTag 组成，文件内容改变后旧的缓存自然不再命中
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        # 文件名 -> 文件大小，按最近使用排序
+        self.files = OrderedDict()
+        self.total_size = 0
+        # 文件名 -> 正在写入的 Future
+        self.loading = {}
+        self.lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+        # 重启后恢复已有的缓存，按访问时间排序
+        entries = []
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if filename.endswith('.tmp'):
+                # 上次没有写完的文件
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_atime, filename, stat.st_size))
+        for _, filename, size in sorted(entries):
+            self.files[filename] = size
+            self.total_size += size
+
+    @staticmethod
+    def filename(key: str) -> str:
+        return hashlib.sha1(key.encode('utf8')).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        filename = self.filename(key)
+        with self.lock:
+            if filename not in self.files.keys():
+                return None
+            self.files.move_to_end(filename)
+        return os.path.join(self.directory, filename)
+
+    def open(self, key: str) -> Optional[BinaryIO]:
+        """
+        在锁内打开缓存的文件，打开后即使被淘汰删除也可以继续读取
+        :param key:
+        :return: 文件对象，未缓存时为 None
+        """
+        filename = self.filename(key)
+        with self.lock:
+            if filename not in self.files.keys():
+                return None
+            try:
+                f = open(os.path.join(self.directory, filename), 'rb')
+            except OSError as e:
+                logger.warning(e)
+                self.total_size -= self.files.pop(filename)
+                return None
+            self.files.move_to_end(filename)
+            return f
+
+    def load(self, key: str, write: Callable[[BinaryIO], None]):
+        """
+        同一个 key 同时只写入一次，同时未命中的其他线程等待写入完成，
+        写入失败时抛出同样的异常
+        :param key:
+        :param write: 将内容写入文件
+        :return:
+        """
+        filename = self.filename(key)
+        with self.lock:
+            if filename in self.files.keys():
+                return
+            future = self.loading.get(filename)
+            waiting = future is not None
+            if not waiting:
+                future = Future()
+                self.loading[filename] = future
+        if waiting:
+            future.result()
+            return
+
+        try:
+            self.put(key, write)
+        except BaseException as e:
+            with self.lock:
+                self.loading.pop(filename, None)
+            future.set_exception(e)
+            raise
+        with self.lock:
+            self.loading.pop(filename, None)
+        future.set_result(None)
+
+    def put(self, key: str, write: Callable[[BinaryIO], None]) -> str:
+        """
+        先写入临时文件，完成后再重命名，其他线程不会读到写了一半的文件
+        :param key:
+        :param write: 将内容写入文件
+        :return: 缓存文件的路径
+        """
+        filename = self.filename(key)
+        path = os.path.join(self.directory, filename)
+        tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        try:
+            with open(tmp_path, 'wb') as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        size = os.path.getsize(path)
+        with self.lock:
+            self.total_size += size - self.files.pop(filename, 0)
+            self.files[filename] = size
+            self.evict()
+        return path
+
+    def evict(self):
+        max_size = g_app_config.get('onedrive',
+                                    'disk_cache_size') * 1024 * 1024
+        while self.total_size > max_size and len(self.files) > 0:
+            filename, size = self.files.popitem(last=False)
+            self.total_size -= size
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except OSError as e:
+                logger.warning(e)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'files': len(self.files), 'size': self.total_size}
+
+
+disk_cache = DiskCache(os.path.join(Config.PROJECT_DIR, 'cache', 'files'))
@@ -64,16 +64,22 @@ def get_token_from_code(callback_url, expected_state):
     return token
 
 
-def refresh_token(token):
+def expires_soon(token, ahead=300):
+    """
+    token 是否在 ahead 秒内过期
+    :param token:
+    :param ahead: 默认5分钟，考虑到时钟误差
+    :return:
+    """
+    return time.time() >= token['expires_at'] - ahead
+
+
+def refresh_token(token, ahead=300):
     if token is None:
         return None
 
     # Check expiration
-    now = time.time()
-    # Subtract 5 minutes from expiration to account for clock skew
-    expire_time = token['expires_at'] - 300
-
-    if now < expire_time:
+    if not expires_soon(token, ahead):
         return token
 
     # Refresh the token
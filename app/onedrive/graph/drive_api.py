@@ -1,9 +1,20 @@
 # -*- coding: utf-8 -*-
+import datetime
+import email.utils
+import logging
+import queue
+import random
+import threading
+import time
 from enum import Enum
-from typing import Optional, Iterator
+from typing import Optional, Iterator, List, Dict
 
 import requests
-from requests_oauthlib import OAuth2Session
+from requests.adapters import HTTPAdapter
+
+from app.app_config import g_app_config
+
+logger = logging.getLogger(__name__)
 
 
 class Method(Enum):
@@ -13,12 +24,27 @@ class Method(Enum):
     DELETE = 'DELETE'
 
 
-base_url = 'https://graph.microsoft.com/v1.0/me/drive'
+graph_url = 'https://graph.microsoft.com/v1.0'
+base_url = '{}/me/drive'.format(graph_url)
 items_url = '{}/items'.format(base_url)
+batch_url = '{}/$batch'.format(graph_url)
+# 一次 $batch 最多包含的子请求数量
+batch_max_size = 20
 
 
-def delta(token: dict, url: Optional[str]) -> Iterator[dict]:
-    url = url or '{}/root/delta'.format(base_url)
+def delta(token: dict, url: Optional[str],
+          select: Optional[List[str]] = None) -> Iterator[dict]:
+    """
+    :param token:
+    :param url: deltaLink 或者 nextLink，为 None 时从头开始
+    :param select: 只返回这些字段，只在 url 为 None 时有效。
+                   nextLink 和 deltaLink 会保留首次请求的 $select
+    :return:
+    """
+    if url is None:
+        url = '{}/root/delta'.format(base_url)
+        if select:
+            url = '{}?$select={}'.format(url, ','.join(select))
     resp_json = {'@odata.nextLink': url}
 
     while '@odata.nextLink' in resp_json.keys():
@@ -29,6 +55,59 @@ def delta(token: dict, url: Optional[str]) -> Iterator[dict]:
         yield resp_json
 
 
+def delta_prefetch(token: dict, url: Optional[str],
+                   select: Optional[List[str]] = None,
+                   max_pages: int = 4) -> Iterator[dict]:
+    """
+    与 delta 相同，但是由后台线程预取后面的页，使网络请求与调用方处理当前页并行。
+    最多缓存 max_pages 页，缓存满时预取线程阻塞等待。
+    预取线程的异常会在调用方取到对应位置时重新抛出；
+    调用方中途退出（异常或者关闭生成器）时，预取线程也会随之结束
+    :param token:
+    :param url:
+    :param select:
+    :param max_pages: 预取队列的最大页数
+    :return:
+    """
+    pages = queue.Queue(maxsize=max_pages)
+    stopped = threading.Event()
+    end = object()
+
+    def put(obj) -> bool:
+        # 带超时的 put，调用方退出后不会一直阻塞在满的队列上
+        while not stopped.is_set():
+            try:
+                pages.put(obj, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch():
+        try:
+            for page in delta(token, url, select):
+                if not put(page):
+                    return
+        except Exception as e:
+            put((end, e))
+            return
+        put(end)
+
+    thread = threading.Thread(target=fetch, name='delta-prefetcher',
+                              daemon=True)
+    thread.start()
+    try:
+        while True:
+            page = pages.get()
+            if page is end:
+                return
+            if isinstance(page, tuple) and page[0] is end:
+                raise page[1]
+            yield page
+    finally:
+        stopped.set()
+
+
 def drive(token: dict) -> dict:
     return request(token, Method.GET, base_url).json()
 
@@ -61,6 +140,116 @@ def content_url(token: dict, item_id: str) -> str:
     return res.headers.get('Location')
 
 
+def download(url: str, **kwargs):
+    """
+    下载预先认证的 url（content_url 或者 $batch 返回的 Location），不需要 token
+    :param url:
+    :param kwargs: 传给 requests，例如 stream、headers
+    :return:
+    """
+    return session().get(url, **kwargs)
+
+
+def batch(token: dict, sub_requests: List[dict], try_times=3) -> List[dict]:
+    """
+    使用 JSON $batch 合并请求，每次最多 batch_max_size 个子请求。
+    被限流或者服务器错误的子请求会放到下一次 $batch 中单独重试，最多请求 try_times 次
+    :param token:
+    :param sub_requests: [{'method': Method, 'url': 完整的 url, 'json': 请求体(可选)}]
+    :param try_times:
+    :return: 与 sub_requests 一一对应的子响应 {'id', 'status', 'headers', 'body'}
+    """
+    responses: List[Optional[dict]] = [None] * len(sub_requests)
+    pending = list(range(len(sub_requests)))
+    attempt = 0
+    while len(pending) > 0:
+        attempt += 1
+        retry = []
+        delay = 0
+        for i in range(0, len(pending), batch_max_size):
+            chunk = pending[i:i + batch_max_size]
+            body = {'requests': []}
+            for idx in chunk:
+                sub = sub_requests[idx]
+                sub_req = {
+                    'id': str(idx),
+                    'method': sub['method'].value,
+                    # 子请求使用相对于 graph_url 的路径
+                    'url': sub['url'][len(graph_url):]
+                }
+                if sub.get('json') is not None:
+                    sub_req['body'] = sub['json']
+                    sub_req['headers'] = {'Content-Type': 'application/json'}
+                body['requests'].append(sub_req)
+
+            resp = request(token, Method.POST, batch_url, json=body)
+            if resp.status_code == 200:
+                sub_responses = resp.json().get('responses') or []
+            else:
+                # 整个 $batch 失败，所有子请求都视为失败
+                sub_responses = [{
+                    'id': str(idx), 'status': resp.status_code,
+                    'headers': dict(resp.headers), 'body': None
+                } for idx in chunk]
+
+            for sub_resp in sub_responses:
+                responses[int(sub_resp['id'])] = sub_resp
+
+            for idx in chunk:
+                sub_resp = responses[idx]
+                if sub_resp is None or \
+                        sub_resp['status'] in (429, 500, 502, 503, 504):
+                    retry.append(idx)
+                    headers = (sub_resp or {}).get('headers') or {}
+                    delay = max(delay, retry_after(headers) or 0)
+
+        if len(retry) == 0 or attempt >= try_times:
+            break
+        pending = retry
+        count(token.get('drive_id'), 'retried', len(retry))
+        time.sleep(delay or backoff(attempt))
+
+    return [sub_resp or {'id': str(idx), 'status': 0, 'headers': {},
+                         'body': None}
+            for idx, sub_resp in enumerate(responses)]
+
+
+def batch_create_link(token: dict, item_ids: List[str],
+                      expiration_date_time: str = None) -> Dict[str, dict]:
+    """
+    批量 create_link
+    :return: item_id -> 与 create_link 相同的响应，失败时包含 error
+    """
+    data = {'type': 'view', 'scope': 'anonymous'}
+    if expiration_date_time:
+        data['expirationDateTime'] = expiration_date_time
+
+    responses = batch(token, [{
+        'method': Method.POST,
+        'url': '{}/{}/createLink'.format(items_url, item_id),
+        'json': data
+    } for item_id in item_ids])
+
+    return {item_id: sub_resp.get('body') or {
+        'error': {'code': str(sub_resp['status'])}
+    } for item_id, sub_resp in zip(item_ids, responses)}
+
+
+def batch_content_url(token: dict,
+                      item_ids: List[str]) -> Dict[str, Optional[str]]:
+    """
+    批量 content_url
+    :return: item_id -> 下载地址，失败时为 None
+    """
+    responses = batch(token, [{
+        'method': Method.GET,
+        'url': '{}/{}/content'.format(items_url, item_id)
+    } for item_id in item_ids])
+
+    return {item_id: (sub_resp.get('headers') or {}).get('Location')
+            for item_id, sub_resp in zip(item_ids, responses)}
+
+
 def put_content(token: dict, item_path: str, data: bytes) -> dict:
     url = '{}/root:{}:/content'.format(base_url, item_path)
     return request(token, Method.PUT, url, data=data).json()
@@ -83,17 +272,167 @@ def delete_permissions(token: dict, item_id: str, perm_id: str) -> int:
     return res.status_code
 
 
-def request(token, method, url, try_times=3, data=None, headers=None,
+_session = None
+_session_lock = threading.Lock()
+
+
+def session() -> requests.Session:
+    """
+    所有 Graph 请求共用一个 Session，复用 keep-alive 连接。
+    token 不保存在 Session 中，而是每次请求时放到请求头，token 刷新后无需重建连接
+    :return:
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            pool_size = g_app_config.get('onedrive', 'graph_pool_size')
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+            _session = requests.Session()
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+class RateLimiter:
+    """
+    令牌桶限流。每秒补充 rate 个令牌，最多积累 capacity 个。
+    被限流（429/503）后调用 pause，在 Retry-After 时间内所有请求都会等待
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        with self.lock:
+            self.paused_until = max(self.paused_until,
+                                    time.monotonic() + seconds)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+# drive id -> 请求统计。没有 drive id 的请求记在 'default' 下
+stats = {}
+stats_lock = threading.Lock()
+
+
+def rate_limiter(drive_id: Optional[str]) -> RateLimiter:
+    """
+    每个 drive 一个限流器，同步、创建链接和上传共用
+    :param drive_id:
+    :return:
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(drive_id)
+        if limiter is None:
+            rate = g_app_config.get('onedrive', 'graph_rate_limit')
+            limiter = RateLimiter(rate, rate * 2)
+            _limiters[drive_id] = limiter
+        return limiter
+
+
+def count(drive_id: Optional[str], key: str, value=1):
+    with stats_lock:
+        drive_stats = stats.setdefault(drive_id or 'default', {
+            'requests': 0, 'throttled': 0, 'retried': 0, 'waited': 0
+        })
+        drive_stats[key] += value
+
+
+def retry_after(headers) -> Optional[float]:
+    """
+    解析 Retry-After 响应头，可能是秒数或者 HTTP 日期
+    :param headers: 响应头，$batch 子响应的响应头是普通的 dict
+    :return: 需要等待的秒数，没有则返回 None
+    """
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+        return max((date - datetime.datetime.now(date.tzinfo))
+                   .total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempt: int) -> float:
+    """
+    指数退避加随机抖动，最长 60 秒
+    :param attempt: 第几次重试，从 1 开始
+    :return:
+    """
+    return random.uniform(0, min(60, 2 ** attempt))
+
+
+def request(token, method, url, try_times=5, data=None, headers=None,
             **kwargs):
-    client = OAuth2Session(token=token)
-    resp = None
-    while try_times > 0 and resp is None:
+    """
+    网络异常和被限流（429/503）时重试，最多请求 try_times 次。
+    被限流时优先按照 Retry-After 等待，否则指数退避；最后一次仍被限流则返回该响应
+    """
+    client = session()
+    drive_id = token.get('drive_id')
+    limiter = rate_limiter(drive_id)
+    headers = {
+        **(headers or {}),
+        'Authorization': '{} {}'.format(token.get('token_type') or 'Bearer',
+                                        token['access_token'])
+    }
+    attempt = 0
+    while True:
+        limiter.acquire()
+        count(drive_id, 'requests')
+        attempt += 1
         try:
             resp = client.request(method.value, url, data=data, headers=headers,
                                   **kwargs)
         except requests.exceptions.RequestException:
-            if try_times == 1:
+            if attempt >= try_times:
                 # 最后一次还是失败
                 raise
-        try_times -= 1
-    return resp
+            count(drive_id, 'retried')
+            time.sleep(backoff(attempt))
+            continue
+
+        if resp.status_code not in (429, 503):
+            return resp
+
+        count(drive_id, 'throttled')
+        if attempt >= try_times:
+            return resp
+        delay = retry_after(resp.headers)
+        if delay is None:
+            delay = backoff(attempt)
+        logger.warning('throttled by graph ({}), retry after {:.1f}s'.format(
+            resp.status_code, delay))
+        count(drive_id, 'retried')
+        count(drive_id, 'waited', delay)
+        # 同一个 drive 的其他请求也一起等待
+        limiter.pause(delay)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import re
+from typing import Iterable, Optional
+
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from app import mongo
+
+mongodb = mongo.db
+
+get_items_projection = {
+    '_id': 0, 'id': 1, 'name': 1, 'file': 1, 'folder': 1,
+    'lastModifiedDateTime': 1, 'size': 1, 'movie_id': 1, 'tv_series_id': 1,
+}
+# 文件夹在前，再按名称排序，最后按 id 排序保证顺序稳定
+default_sort = [('ftype', 1), ('name', 1), ('id', 1)]
+add_ftype = {'$addFields': {'ftype': {'$cond': [
+    {'$ifNull': ['$folder', False]}, 0, 1
+]}}}
+# 每个文件夹的列表文档最多保存的子项数量，更多的子项通过查询分页获取
+listing_size = 200
+
+
+def drive_epoch(drive_id: str) -> int:
+    """
+    invalidate_tree 每次调用时加一
+    """
+    doc = mongodb.drive.find_one({'id': drive_id}, {'listing_epoch': 1})
+    return (doc or {}).get('listing_epoch', 0)
+
+
+def build(drive_id: str, path: str) -> dict:
+    """
+    生成文件夹的列表文档：子项数量、按默认顺序排列的前 listing_size 个子项
+    以及 HEAD.md 和 README.md 的内容。
+    生成期间如果同步删除了这个列表文档（version 或者 drive 的 listing_epoch
+    改变了），生成的文档可能是旧的，不保存
+    :param drive_id:
+    :param path: 子项的 parentReference.path
+    :return:
+    """
+    state = mongodb.folder_listing.find_one(
+        {'drive_id': drive_id, 'path': path}, {'version': 1})
+    version = (state or {}).get('version', 0)
+    epoch = drive_epoch(drive_id)
+
+    match = {'parentReference.driveId': drive_id,
+             'parentReference.path': path}
+    doc = {
+        'drive_id': drive_id,
+        'path': path,
+        'version': version,
+        'stale': False,
+        'count': mongodb.item.count_documents(match),
+        'children': list(mongodb.item.aggregate([
+            {'$match': match},
+            {'$project': get_items_projection},
+            add_ftype,
+            {'$sort': dict(default_sort)},
+            {'$limit': listing_size}
+        ])),
+        'head': None,
+        'readme': None
+    }
+    for item in mongodb.item.find(
+            {**match, 'name': {'$in': ['README.md', 'HEAD.md']}},
+            {'_id': 0, 'name': 1, 'content': 1}
+    ):
+        if item['name'] == 'README.md':
+            doc['readme'] = item.get('content')
+        if item['name'] == 'HEAD.md':
+            doc['head'] = item.get('content')
+
+    if doc['count'] == 0 and state is None:
+        # 不保存空文件夹和不存在的路径，避免任意请求路径产生大量文档
+        return doc
+
+    query = {'drive_id': drive_id, 'path': path,
+             'version': version if version else {'$in': [0, None]}}
+    try:
+        # version 改变了时不匹配，插入新文档违反唯一索引
+        mongodb.folder_listing.replace_one(query, doc, upsert=True)
+    except DuplicateKeyError:
+        return doc
+    if drive_epoch(drive_id) != epoch:
+        mongodb.folder_listing.delete_one(query)
+    doc.pop('_id', None)
+    return doc
+
+
+def get(drive_id: str, path: str) -> dict:
+    """
+    读取文件夹的列表文档，不存在或者已失效则生成
+    :param drive_id:
+    :param path:
+    :return:
+    """
+    doc = mongodb.folder_listing.find_one({'drive_id': drive_id, 'path': path},
+                                          {'_id': 0})
+    if doc is None or doc.get('stale'):
+        return build(drive_id, path)
+    return doc
+
+
+def complete(doc: dict) -> bool:
+    """
+    列表文档是否包含了所有子项
+    """
+    return doc['count'] <= len(doc['children'])
+
+
+def invalidate(drive_id: str, paths: Iterable[str]):
+    """
+    使这些文件夹的列表文档失效，下次读取时重新生成。
+    增加 version，正在生成的列表文档不会覆盖
+    """
+    paths = list(paths)
+    if len(paths) > 0:
+        mongodb.folder_listing.bulk_write([
+            UpdateOne({'drive_id': drive_id, 'path': path},
+                      {'$inc': {'version': 1}, '$set': {'stale': True}},
+                      upsert=True)
+            for path in paths
+        ], ordered=False)
+
+
+def invalidate_tree(drive_id: str, path: Optional[str] = None):
+    """
+    删除 path 及其所有子文件夹的列表文档，path 为 None 时删除整个 drive 的。
+    增加 drive 的 listing_epoch，正在生成的列表文档写入后会被删除
+    """
+    mongodb.drive.update_one({'id': drive_id},
+                             {'$inc': {'listing_epoch': 1}})
+    query = {'drive_id': drive_id}
+    if path is not None:
+        query['path'] = {'$regex': '^{}(/|$)'.format(re.escape(path))}
+    mongodb.folder_listing.delete_many(query)
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+import logging
+import sys
+import threading
+from typing import Iterable, List, Optional
+
+from app import mongo
+from app.app_config import g_app_config
+
+logger = logging.getLogger(__name__)
+mongodb = mongo.db
+
+# 建立目录树时从 MongoDB 读取的字段
+node_projection = {'_id': 0, 'id': 1, 'name': 1, 'size': 1, 'folder': 1,
+                   'root': 1, 'parentReference.id': 1}
+
+
+class Node:
+    __slots__ = ('id', 'name', 'parent_id', 'size', 'is_folder', 'children')
+
+    def __init__(self, doc: dict):
+        self.id = doc['id']
+        self.name = doc.get('name')
+        self.parent_id = (doc.get('parentReference') or {}).get('id')
+        self.size = doc.get('size')
+        self.is_folder = 'folder' in doc.keys() or 'root' in doc.keys()
+        # 子项名称 -> 子项 id，文件为 None
+        self.children = {} if self.is_folder else None
+
+    def to_dict(self) -> dict:
+        return {'id': self.id, 'name': self.name, 'size': self.size,
+                'type': 'folder' if self.is_folder else 'file'}
+
+
+class DriveTree:
+    """
+    一个 drive 的目录树，只保存 id、名称、大小和父子关系。
+    节点按 parentReference.id 连接，文件夹移动后子项不需要修改
+    """
+
+    def __init__(self, drive_id: str):
+        self.drive_id = drive_id
+        # item id -> Node
+        self.nodes = {}
+        self.root_id = None
+        self.lock = threading.RLock()
+
+    def build(self):
+        nodes = {}
+        root_id = None
+        for doc in mongodb.item.find({'parentReference.driveId':
+                                      self.drive_id},
+                                     node_projection, batch_size=5000):
+            node = Node(doc)
+            nodes[node.id] = node
+            if 'root' in doc.keys():
+                root_id = node.id
+        for node in nodes.values():
+            parent = nodes.get(node.parent_id)
+            if parent is not None and parent.is_folder:
+                parent.children[node.name] = node.id
+        with self.lock:
+            self.nodes = nodes
+            self.root_id = root_id
+
+    def apply(self, items: Iterable[dict]):
+        """
+        把 delta 返回的 item 更新到目录树中
+        :param items:
+        :return:
+        """
+        with self.lock:
+            added = []
+            for item in items:
+                if 'deleted' in item.keys():
+                    self.remove(item['id'])
+                    continue
+                node = Node(item)
+                old = self.nodes.get(node.id)
+                if old is not None:
+                    self.detach(old)
+                    if old.is_folder and node.is_folder:
+                        node.children = old.children
+                self.nodes[node.id] = node
+                if 'root' in item.keys():
+                    self.root_id = node.id
+                added.append(node)
+
+            # 全部节点更新后再连接父节点，同一批中子项可能在父文件夹之前
+            for node in added:
+                if self.nodes.get(node.id) is not node:
+                    # 同一批中又被删除或者更新了
+                    continue
+                parent = self.nodes.get(node.parent_id)
+                if parent is not None and parent.is_folder:
+                    parent.children[node.name] = node.id
+
+    def detach(self, node: Node):
+        parent = self.nodes.get(node.parent_id)
+        if parent is not None and parent.is_folder \
+                and parent.children.get(node.name) == node.id:
+            del parent.children[node.name]
+
+    def remove(self, item_id: str):
+        node = self.nodes.pop(item_id, None)
+        if node is not None:
+            self.detach(node)
+
+    def find(self, path: str) -> Optional[Node]:
+        """
+        :param path: 相对于 drive 根目录的路径，根目录为空字符串或 '/'
+        :return:
+        """
+        with self.lock:
+            node = self.nodes.get(self.root_id)
+            for name in path.split('/'):
+                if name == '':
+                    continue
+                if node is None or not node.is_folder:
+                    return None
+                node = self.nodes.get(node.children.get(name))
+            return node
+
+    def list_children(self, path: str) -> Optional[List[Node]]:
+        with self.lock:
+            node = self.find(path)
+            if node is None or not node.is_folder:
+                return None
+            return [self.nodes[item_id] for item_id in node.children.values()
+                    if item_id in self.nodes.keys()]
+
+    def memory_size(self) -> int:
+        """
+        估算占用的内存，单位字节
+        """
+        with self.lock:
+            size = sys.getsizeof(self.nodes)
+            for node in self.nodes.values():
+                size += sys.getsizeof(node) + sys.getsizeof(node.id) + \
+                        sys.getsizeof(node.name)
+                if node.children is not None:
+                    size += sys.getsizeof(node.children)
+            return size
+
+
+class TreeIndex:
+    """
+    所有 drive 的目录树。onedrive.tree_index 关闭或者目录树还没建立时，
+    get 返回 None，调用方使用 MongoDB 查询
+    """
+
+    def __init__(self):
+        # drive id -> DriveTree
+        self.trees = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def enabled() -> bool:
+        return g_app_config.get('onedrive', 'tree_index')
+
+    def get(self, drive_id: str) -> Optional[DriveTree]:
+        if not self.enabled():
+            return None
+        tree = self.trees.get(drive_id)
+        if tree is None or tree.root_id is None:
+            # 没有根目录（例如同步字段中没有 root）时无法按路径查找
+            return None
+        return tree
+
+    def build(self, drive_id: str):
+        if not self.enabled():
+            return
+        tree = DriveTree(drive_id)
+        tree.build()
+        with self.lock:
+            self.trees[drive_id] = tree
+        logger.info('drive({}) tree index built: {} nodes'.format(
+            drive_id, len(tree.nodes)))
+
+    def build_all(self, drive_ids: Iterable[str]):
+        for drive_id in drive_ids:
+            try:
+                self.build(drive_id)
+            except Exception as e:
+                logger.error(e)
+
+    def apply(self, items: Iterable[dict]):
+        """
+        按 driveId 把 item 更新到对应的目录树，没有目录树的 drive 忽略
+        """
+        groups = {}
+        for item in items:
+            drive_id = (item.get('parentReference') or {}).get('driveId')
+            groups.setdefault(drive_id, []).append(item)
+        for drive_id, group in groups.items():
+            if drive_id is None:
+                # 已删除的 item 可能没有 driveId，只需要按 id 删除
+                for tree in list(self.trees.values()):
+                    tree.apply(item for item in group
+                               if 'deleted' in item.keys())
+                continue
+            tree = self.trees.get(drive_id)
+            if tree is not None:
+                tree.apply(group)
+
+    def drop(self, drive_id: str):
+        with self.lock:
+            self.trees.pop(drive_id, None)
+
+    def stats(self) -> dict:
+        return {drive_id: {'nodes': len(tree.nodes),
+                           'memory': tree.memory_size()}
+                for drive_id, tree in list(self.trees.items())}
+
+
+tree_index = TreeIndex()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import datetime
+import hashlib
+import hmac
+import os
+import threading
+import time
+import uuid
+from typing import Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from app import mongo
+
+# 签名 token 的格式：前缀.过期时间.随机 id.签名
+prefix = 's1'
+# 多久从 MongoDB 同步一次其他进程注销的 token（秒）
+revocation_sync_interval = 5
+
+key_lock = threading.Lock()
+_key = None
+
+
+def signing_key() -> bytes:
+    """
+    签名密钥保存在 MongoDB，所有进程共用，重启后已签发的 token 仍然有效
+    """
+    global _key
+    with key_lock:
+        if _key is None:
+            doc = mongo.db.app_secret.find_one_and_update(
+                {'name': 'token_signing_key'},
+                {'$setOnInsert': {'value': os.urandom(32).hex()}},
+                upsert=True, return_document=ReturnDocument.AFTER)
+            _key = bytes.fromhex(doc['value'])
+        return _key
+
+
+def sign(payload: str) -> str:
+    return hmac.new(signing_key(), payload.encode('utf8'),
+                    hashlib.sha256).hexdigest()
+
+
+def is_signed(token: Optional[str]) -> bool:
+    return token is not None and token.startswith(prefix + '.')
+
+
+def issue(expires_at: float) -> str:
+    payload = '{}.{}.{}'.format(prefix, int(expires_at), uuid.uuid4().hex)
+    return '{}.{}'.format(payload, sign(payload))
+
+
+def parse(token: Optional[str]) -> Optional[dict]:
+    """
+    校验签名和过期时间，不查询数据库
+    :param token:
+    :return: 有效时返回 {'token_id', 'expires_at'}，否则返回 None
+    """
+    if not is_signed(token):
+        return None
+    parts = token.split('.')
+    if len(parts) != 4:
+        return None
+    _, expires_at, token_id, signature = parts
+    if not hmac.compare_digest(sign('.'.join(parts[:3])), signature):
+        return None
+    if not expires_at.isdigit() or int(expires_at) <= time.time():
+        return None
+    return {'token_id': token_id, 'expires_at': int(expires_at)}
+
+
+class RevocationList:
+    """
+    已注销的签名 token 的 id。注销时写入 MongoDB，
+    每个进程定时读取最近注销的 id 合并到内存中，过期的 id 从内存中删除
+    """
+
+    def __init__(self):
+        # token id -> 过期时间
+        self.revoked = {}
+        self.synced_at = 0
+        self.lock = threading.Lock()
+
+    def revoke(self, token_id: str, expires_at: float) -> bool:
+        """
+        token_id 有唯一索引，同一个 token 只能注销一次
+        :return: 是否是本次注销的
+        """
+        try:
+            mongo.db.token_revoked.insert_one({
+                'token_id': token_id,
+                'revoked_at': time.time(),
+                # TTL 索引在 token 过期后删除记录
+                'expires_at': datetime.datetime.utcfromtimestamp(expires_at)
+            })
+        except DuplicateKeyError:
+            # 已经被其他请求注销
+            return False
+        with self.lock:
+            self.revoked[token_id] = expires_at
+        return True
+
+    def sync(self):
+        now = time.time()
+        with self.lock:
+            if now - self.synced_at < revocation_sync_interval:
+                return
+            since = self.synced_at
+            self.synced_at = now
+        # 多读一段时间，避免漏掉其他进程在同步期间写入的记录
+        docs = list(mongo.db.token_revoked.find(
+            {'revoked_at': {'$gt': since - revocation_sync_interval}},
+            {'_id': 0, 'token_id': 1, 'expires_at': 1}))
+        with self.lock:
+            for doc in docs:
+                self.revoked[doc['token_id']] = doc['expires_at'].replace(
+                    tzinfo=datetime.timezone.utc).timestamp()
+            for token_id in [k for k, v in self.revoked.items() if v <= now]:
+                del self.revoked[token_id]
+
+    def is_revoked(self, token_id: str) -> bool:
+        self.sync()
+        with self.lock:
+            return token_id in self.revoked.keys()
+
+
+revocation_list = RevocationList()
+
+
+def verify(token: Optional[str]) -> bool:
+    claims = parse(token)
+    return claims is not None and \
+        not revocation_list.is_revoked(claims['token_id'])
+
+
+def revoke(token: Optional[str]) -> bool:
+    """
+    :param token:
+    :return: token 有效并且注销成功时返回 True
+    """
+    claims = parse(token)
+    if claims is None or revocation_list.is_revoked(claims['token_id']):
+        return False
+    return revocation_list.revoke(claims['token_id'], claims['expires_at'])
@@ -10,6 +10,8 @@ from .tmdb import TMDb
 
 logger = logging.getLogger(__name__)
 mongodb = mongo.db
+# TMDb 数据的数据范围，数据改变后 data_versions 中的版本号加一
+data_scope = 'tmdb'
 
 
 class MyTMDb(TMDb):
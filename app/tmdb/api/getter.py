@@ -1,10 +1,20 @@
 # -*- coding: utf-8 -*-
+import json
 from typing import Literal, Optional
 
 from flask_jsonrpc.exceptions import InvalidRequestError
 
 from app import jsonrpc_bp
-from .. import mongodb
+from app.common import Utils, LRUCache, versioned_cache, data_versions
+from .. import mongodb, data_scope
+
+# 公开的查询方法的返回值，TMDb 数据更新后不再命中
+response_cache = LRUCache(max_size=2048)
+
+
+def library_scope(params: dict) -> str:
+    return data_scope
+
 
 get_movie_projection = {
     '_id': 0,
@@ -25,6 +35,7 @@ get_movie_projection = {
 
 
 @jsonrpc_bp.method('TMDb.getMovie')
+@versioned_cache(response_cache, library_scope)
 def get_movie(movie_id: int, append_collection: bool = False) -> dict:
     for item in mongodb.tmdb_movie.aggregate([
         {'$match': {'id': movie_id}},
@@ -54,16 +65,48 @@ get_movies_projection.pop('belongs_to_collection', None)
 get_movies_projection.pop('directors', None)
 
 
+def match_fields(match) -> list:
+    """
+    查询条件中用到的所有字段，包括 $and、$or、$nor 中的
+    """
+    fields = []
+    if isinstance(match, dict):
+        for k, v in match.items():
+            if k in ('$and', '$or', '$nor') and isinstance(v, list):
+                for sub in v:
+                    fields.extend(match_fields(sub))
+            elif not k.startswith('$'):
+                fields.append(k)
+    return fields
+
+
+# 统计电影数量的缓存，键集分页时不需要每一页都重新统计。
+# key 带有 TMDb 数据的版本号，数据改变后不再命中
+count_cache = LRUCache(max_size=256, ttl=60)
+
+
 @jsonrpc_bp.method('TMDb.getMovies')
+@versioned_cache(response_cache, library_scope)
 def get_movies(
         match: dict = None,
         skip: int = 0, limit: int = 25,
         order: Literal['asc', 'desc'] = 'desc',
-        order_by: Literal['release_date'] = 'release_date'
+        order_by: Literal['release_date'] = 'release_date',
+        cursor: str = None
 ) -> dict:
+    """
+    cursor 为 None 时使用 skip 分页；否则使用键集分页并忽略 skip，
+    第一页传空字符串，之后传上一页结果中的 cursor。
+    结果中的 cursor 用于获取下一页，为 None 表示没有下一页
+    """
     if match is None:
         match = {}
-    for result in mongodb.tmdb_movie.aggregate([
+    # 多个电影release_date相同，导致sort排序不稳定，再加个title和id字段。
+    # 三个字段方向相同，升序和降序可以使用同一个索引
+    direction = 1 if order == 'asc' else -1
+    sort = [(order_by, direction), ('title', direction), ('id', direction)]
+    tag = '{}:{}'.format(order_by, order)
+    pipeline = [
         {'$lookup': {
             'from': 'tmdb_person',
             'localField': 'directors',
@@ -71,6 +114,51 @@ def get_movies(
             'as': 'directors'
         }},
         {'$match': match},
+    ]
+
+    if cursor is not None:
+        try:
+            last = Utils.parse_cursor(cursor, tag)
+        except ValueError as e:
+            raise InvalidRequestError(message=str(e))
+
+        # 查询条件不涉及导演时，先在索引字段上 $match、$sort、$limit，
+        # 只对这一页的电影做 $lookup 和 $project
+        uses_directors = any(f.split('.')[0] == 'directors'
+                             for f in match_fields(match))
+        head = pipeline if uses_directors else [{'$match': match}]
+
+        def count():
+            if not uses_directors:
+                return mongodb.tmdb_movie.count_documents(match)
+            for doc in mongodb.tmdb_movie.aggregate(
+                    pipeline + [{'$count': 'count'}]):
+                return doc['count']
+            return 0
+
+        list_pipeline = list(head)
+        if last is not None:
+            list_pipeline.append({'$match': Utils.keyset_match(sort, last)})
+        list_pipeline.extend([
+            {'$sort': dict(sort)},
+            {'$limit': limit},
+            {'$set': {'poster': {'$arrayElemAt': ['$images.posters', 0]}}},
+            {'$project': {
+                **get_movies_projection,
+                'poster_path': '$poster.file_path'
+            }},
+        ])
+
+        docs = list(mongodb.tmdb_movie.aggregate(list_pipeline))
+        return {
+            'count': count_cache.get_or_load(
+                json.dumps([data_versions.get(data_scope), match],
+                           sort_keys=True), count),
+            'list': docs,
+            'cursor': Utils.next_cursor(docs, sort, limit, tag)
+        }
+
+    for result in mongodb.tmdb_movie.aggregate(pipeline + [
         {'$set': {'poster': {'$arrayElemAt': ['$images.posters', 0]}}},
         {'$project': {
             **get_movies_projection,
@@ -79,11 +167,7 @@ def get_movies(
         {'$facet': {
             'count': [{'$count': 'count'}],
             'list': [
-                {'$sort': {
-                    order_by: 1 if order == 'asc' else -1,
-                    # 多个电影release_date相同，导致sort排序不稳定，再加个title字段
-                    'title': 1
-                }},
+                {'$sort': dict(sort)},
                 {'$skip': skip},
                 {'$limit': limit}
             ]
@@ -94,12 +178,14 @@ def get_movies(
         }}}},
         {'$set': {'count': {'$ifNull': ['$count', {'$toInt': 0}]}}}
     ]):
+        result['cursor'] = Utils.next_cursor(result['list'], sort, limit, tag)
         return result
 
-    return {'count': 0, 'list': []}
+    return {'count': 0, 'list': [], 'cursor': None}
 
 
 @jsonrpc_bp.method('TMDb.getCollection')
+@versioned_cache(response_cache, library_scope)
 def get_collection(collection_id: int) -> Optional[dict]:
     for item in mongodb.tmdb_collection.aggregate([
         {'$match': {'id': collection_id}},
@@ -159,5 +245,6 @@ def get_items_by_movie_id(movie_id: int) -> list:
     if len(res) == 0:
         # 没有资源
         mongodb.tmdb_movie.delete_one({'id': movie_id})
+        data_versions.bump(data_scope)
 
     return res
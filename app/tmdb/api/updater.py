@@ -4,8 +4,8 @@ import logging
 from typing import Union, List
 
 from app import jsonrpc_bp
-from app.common import Utils
-from .. import mongodb, MyTMDb
+from app.common import Utils, data_versions
+from .. import mongodb, MyTMDb, data_scope
 from ..lang import get_langs
 
 logger = logging.getLogger(__name__)
@@ -15,6 +15,8 @@ logger = logging.getLogger(__name__)
 def update_movies(drive_ids: Union[str, list]) -> int:
     from app.onedrive.api.manage import get_settings
     from app.onedrive.api import onedrive_root_path
+    from app.onedrive import listing
+    from app.onedrive import data_scope as drive_scope
 
     ids = []
     if isinstance(drive_ids, str):
@@ -29,12 +31,12 @@ def update_movies(drive_ids: Union[str, list]) -> int:
     instance = MyTMDb()
 
     for drive_id in ids:
-        movies_path = get_settings(drive_id)['movies_path']
+        movies_path = Utils.path_join(onedrive_root_path,
+                                      get_settings(drive_id)['movies_path'])
 
         for item in mongodb.item.find({
             'parentReference.driveId': drive_id,
-            'parentReference.path': Utils.path_join(
-                onedrive_root_path, movies_path)
+            'parentReference.path': movies_path
         }):
             # 如果是文件且是视频，则用文件名去匹配tmdb信息
             # 如果是文件夹并且子项有视频，则用文件夹的名字去匹配tmdb信息
@@ -61,6 +63,9 @@ def update_movies(drive_ids: Union[str, list]) -> int:
                     {'id': item['id']},
                     {'$set': {'movie_id': movie_id}}
                 )
+                # 列表文档中包含 movie_id
+                listing.invalidate(drive_id, [movies_path])
+                data_versions.bump(drive_scope(drive_id))
 
             # movie
             if mongodb.tmdb_movie.count_documents({
@@ -84,6 +89,7 @@ def update_movies(drive_ids: Union[str, list]) -> int:
             mongodb.tmdb_movie.update_one({'id': movie['id']},
                                           {'$set': movie},
                                           upsert=True)
+            data_versions.bump(data_scope)
             res += 1
 
     if res > 0:
@@ -129,6 +135,7 @@ def update_movie_images(
             {'id': m_id},
             {'$set': {'images': images}}
         )
+        data_versions.bump(data_scope)
         return 1
 
     res = 0
@@ -201,6 +208,7 @@ def update_directors(
         )
         mongodb.tmdb_movie.update_one({'id': m_id},
                                       {'$set': {'directors': director_ids}})
+        data_versions.bump(data_scope)
         return 1
 
     res = 0
@@ -260,6 +268,7 @@ def update_collections(
         mongodb.tmdb_collection.update_one({'id': c_id},
                                            {'$set': collection},
                                            upsert=True)
+        data_versions.bump(data_scope)
         return 1
 
     res = 0
@@ -318,6 +327,7 @@ def update_persons(
         mongodb.tmdb_person.update_one({'id': p_id},
                                        {'$set': person},
                                        upsert=True)
+        data_versions.bump(data_scope)
         return 1
 
     res = 0